@@ -5,3 +5,5 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from .dharma import *  # noqa pylint: disable=wildcard-import
+from .core.extensions import DharmaError  # noqa
+from .core.grammar import DharmaGrammar  # noqa
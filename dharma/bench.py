@@ -0,0 +1,193 @@
+# coding=utf-8
+"dharma benchmarks"
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from collections import OrderedDict
+
+from .__version__ import __version__
+from .core.dharma import DharmaMachine
+from .core.engine import DharmaFlatEngine
+from .core.extensions import DharmaConst
+from .core.rng import RNG_BACKENDS, rng_backend
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class DharmaBenchmark:
+    """Benchmarks of the bundled grammars.
+
+    Startup times the phases of loading every grammar alone and all of them combined. Generation measures, per grammar
+    and engine, the test cases and characters generated per second from a fixed seed, the percentiles of the time
+    per test case and the peak memory. Every generation benchmark runs in a freshly spawned process, hence the peak
+    memory is its own as well.
+    """
+
+    GRAMMARS = ('canvas2d', 'json', 'svg', 'url', 'wasm', 'xss')
+    ENGINES = ('object', 'flat')
+    PHASES = ('parse', 'resolve', 'leaf_paths', 'alias_tables', 'repeat_spaces')
+    PERCENTILES = (50, 90, 99)
+
+    @classmethod
+    def parse_args(cls):
+        parser = argparse.ArgumentParser(description='Dharma Benchmark', prog='dharma.bench')
+        parser.add_argument('-count', metavar='#', type=int, default=200,
+                            help='number of test cases generated per grammar and engine, 0 skips generation')
+        parser.add_argument('-engines', metavar='name', nargs='+', choices=cls.ENGINES, default=list(cls.ENGINES),
+                            help='engines to benchmark generation with')
+        parser.add_argument('-grammars', metavar='name', nargs='+', default=list(cls.GRAMMARS),
+                            help='bundled grammars to benchmark')
+        parser.add_argument('-json', metavar='file',
+                            help='write the results as JSON to this file, - for stdout instead of the tables')
+        parser.add_argument('-recursion-limit', metavar='#', type=int, default=20000,
+                            help='max python recursion limit, as for dharma')
+        parser.add_argument('-repeat', metavar='#', type=int, default=5,
+                            help='number of runs of which the fastest is reported')
+        parser.add_argument('-rng', choices=sorted(RNG_BACKENDS), default='random',
+                            help='random generator of the generated test cases')
+        parser.add_argument('-seed', metavar='#', type=int, default=1, help='seed of the generated test cases')
+        parser.add_argument('-settings', metavar='file', default=os.path.join(HERE, 'settings.py'),
+                            help='settings file')
+        return parser.parse_args()
+
+    @staticmethod
+    def grammar_path(name):
+        return os.path.join(HERE, 'grammars', '%s.dg' % name)
+
+    @classmethod
+    def load(cls, names, settings, seed=0, rng='random'):
+        machine = DharmaMachine(seed=seed, rng=rng_backend(rng))
+        with open(settings) as fo:
+            machine.process_settings(fo)
+        grammars = [open(cls.grammar_path(name)) for name in names]
+        try:
+            machine.process_grammars(grammars)
+        finally:
+            for fo in grammars:
+                fo.close()
+        return machine
+
+    @classmethod
+    def startup(cls, names, settings, repeat):
+        """Return the fastest time in seconds of every loading phase over |repeat| runs."""
+        consts = DharmaConst.snapshot()
+        best = {}
+        for _ in range(repeat):
+            DharmaConst.restore(consts)
+            machine = cls.load(names, settings)
+            for phase, elapsed in machine.load_times.items():
+                best[phase] = min(best.get(phase, elapsed), elapsed)
+        DharmaConst.restore(consts)
+        return best
+
+    @staticmethod
+    def peak_memory():
+        """Return the peak resident memory of the process in bytes, None where unknown."""
+        try:
+            import resource  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    @classmethod
+    def generation(cls, name, settings, engine, count, seed, rng, recursion_limit):  # pylint: disable=R0913
+        """Generate the test cases numbered 1 to |count| of a grammar and return the measurements."""
+        sys.setrecursionlimit(recursion_limit)
+        logging.basicConfig(format='[Dharma] %(asctime)s %(levelname)s: %(message)s', level=logging.ERROR)
+        machine = cls.load([name], settings, seed, rng)
+        if engine == 'flat':
+            machine.engine = DharmaFlatEngine(machine)
+        clock = time.perf_counter
+        latencies, size = [], 0
+        start = clock()
+        for n in range(1, count + 1):
+            case_start = clock()
+            size += len(machine.generate_content(n))
+            latencies.append(clock() - case_start)
+        elapsed = clock() - start
+        latencies.sort()
+        result = {
+            'grammar': name,
+            'engine': engine,
+            'cases': count,
+            'seconds': elapsed,
+            'cases_per_second': count / elapsed,
+            'characters_per_second': size / elapsed,
+            'peak_memory': cls.peak_memory(),
+        }
+        for percentile in cls.PERCENTILES:
+            result['latency_p%d' % percentile] = latencies[min(count - 1, count * percentile // 100)]
+        result['latency_max'] = latencies[-1]
+        return result
+
+    @classmethod
+    def run_generation(cls, *args):
+        """Run generation() in a new process. It is spawned rather than forked, a fork starts at the peak memory of
+        its parent."""
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            return pool.apply(cls.generation, args)
+
+    @classmethod
+    def print_tables(cls, results, out):
+        columns = cls.PHASES + ('total',)
+        out.write('%-24s' % 'grammar' + ''.join(' %13s' % phase for phase in columns) + '\n')
+        for label, times in results['startup'].items():
+            out.write('%-24s' % label + ''.join(' %11.1fms' % (times[phase] * 1000) for phase in columns) + '\n')
+        if not results['generation']:
+            return
+        out.write('\n%-12s %-8s %10s %12s %9s %9s %9s %9s %9s\n' % (
+            'grammar', 'engine', 'cases/s', 'chars/s', 'p50', 'p90', 'p99', 'max', 'peak'))
+        for r in results['generation']:
+            peak = '%7.1fMB' % (r['peak_memory'] / (1 << 20)) if r['peak_memory'] is not None else 'n/a'
+            out.write('%-12s %-8s %10.1f %12.0f %7.2fms %7.2fms %7.2fms %7.2fms %9s\n' % (
+                r['grammar'], r['engine'], r['cases_per_second'], r['characters_per_second'],
+                r['latency_p50'] * 1000, r['latency_p90'] * 1000, r['latency_p99'] * 1000, r['latency_max'] * 1000,
+                peak))
+
+    @classmethod
+    def main(cls):
+        args = cls.parse_args()
+        sys.setrecursionlimit(args.recursion_limit)
+        logging.basicConfig(format='[Dharma] %(asctime)s %(levelname)s: %(message)s', level=logging.ERROR)
+        results = {
+            'dharma': __version__,
+            'python': platform.python_version(),
+            'seed': args.seed,
+            'rng': args.rng,
+            'startup': OrderedDict(),
+            'generation': [],
+        }
+        runs = [[name] for name in args.grammars]
+        if len(args.grammars) > 1:
+            runs.append(args.grammars)
+        for names in runs:
+            best = cls.startup(names, args.settings, args.repeat)
+            best['total'] = sum(best[phase] for phase in cls.PHASES)
+            results['startup'][names[0] if len(names) == 1 else 'combined'] = best
+        if args.count > 0:
+            for name in args.grammars:
+                for engine in args.engines:
+                    results['generation'].append(cls.run_generation(name, args.settings, engine, args.count,
+                                                                    args.seed, args.rng, args.recursion_limit))
+        if args.json == '-':
+            json.dump(results, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            cls.print_tables(results, sys.stdout)
+            if args.json:
+                with open(args.json, 'w') as fo:
+                    json.dump(results, fo, indent=2)
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(DharmaBenchmark.main())
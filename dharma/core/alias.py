@@ -0,0 +1,32 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+class DharmaAliasTable:
+    """Samples the indices of |weights| in proportion to their weight in constant time, using the alias method of
+    Walker in the variant of Vose. Every index gets a bucket of equal probability, which holds a share of the index
+    itself and the remainder of an alias. A single random float picks the bucket by its integer part and the index
+    or its alias by its fractional part.
+    """
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        scaled = [w * n / total for w in weights]
+        self.n = n
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = scaled[s], l
+            scaled[l] += scaled[s] - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        # Buckets left over in either list are full up to rounding errors and keep a probability of 1.
+
+    def sample(self, rng):
+        x = rng.random() * self.n
+        i = min(int(x), self.n - 1)
+        return i if x - i < self.prob[i] else self.alias[i]
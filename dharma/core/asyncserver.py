@@ -0,0 +1,291 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import asyncio
+import email.parser
+import logging
+import urllib.parse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from dharma.core.dharma import _generate_testcase_worker
+from dharma.core.websocket import (CLOSE_TOO_BIG, MAX_MESSAGE_SIZE, OPCODES, FrameHeader, encode_reply, frame_header,
+                                   handshake_response, parse_message)
+
+
+class AsyncWebSocket:
+    """Server side of a WebSocket connection on asyncio streams."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def accept(self):
+        """Read the upgrade request and accept it."""
+        request = await self.reader.readuntil(b'\r\n\r\n')
+        _, headers = request.decode('ascii').split('\r\n', 1)
+        headers = email.parser.HeaderParser().parsestr(headers)
+        if headers['sec-websocket-key'] is None:
+            raise ConnectionError('Not a WebSocket upgrade request')
+        self.writer.write(handshake_response(headers['sec-websocket-key']))
+        await self.writer.drain()
+
+    async def read_frame(self, buffered):
+        """Return the next frame as a tuple (fin, opcode, payload), or None if a message of |buffered| bytes
+        so far would exceed MAX_MESSAGE_SIZE, after closing the connection.
+        """
+        header = FrameHeader(await self.reader.readexactly(2))
+        if header.remaining:
+            header.complete(await self.reader.readexactly(header.remaining))
+        if header.exceeds(buffered):
+            logging.warning('Closing connection on a message exceeding %d bytes', MAX_MESSAGE_SIZE)
+            await self.send(8, CLOSE_TOO_BIG)
+            return None
+        return header.fin, header.opcode, header.payload(await self.reader.readexactly(header.length))
+
+    async def receive(self):
+        """Return the next message as a tuple (opcode, payload), or None once the connection got closed."""
+        buf = None
+        buf_op = None
+        try:
+            while True:
+                frame = await self.read_frame(len(buf) if buf is not None else 0)
+                if frame is None:
+                    return None
+                fin, code, data = frame
+                opcode = OPCODES.get(code)
+                if opcode == 'close':
+                    return None
+                if opcode == 'pong':
+                    continue
+                if opcode == 'ping':
+                    await self.send(10, data)
+                    continue
+                if opcode == 'continue':
+                    if buf is None:
+                        logging.warning('Received a continuation frame without a message to continue')
+                        continue
+                    buf += data
+                elif opcode in ('text', 'binary'):
+                    if buf is not None:
+                        logging.warning('Received a new frame while waiting for another to finish, '
+                                        'discarding %u bytes of %s', len(buf), buf_op)
+                    buf, buf_op = bytearray(data), opcode
+                else:
+                    logging.warning('Unknown websocket opcode %d', code)
+                    continue
+                if fin:
+                    return buf_op, bytes(buf)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    async def send(self, opcode, data):
+        self.writer.write(frame_header(opcode, len(data)))
+        if data:
+            self.writer.write(data)
+        await self.writer.drain()
+
+    async def write_message(self, message, binary=False):
+        if binary:
+            await self.send(2, message)
+        else:
+            await self.send(1, message.encode('utf8'))
+
+
+class DharmaAsyncServer:  # pylint: disable=too-many-instance-attributes
+    """Base of servers on an asyncio event loop which serve test cases generated ahead of demand.
+
+    A pool of |jobs| processes fills a queue of up to |queue_size| test cases, each generated from its own seed
+    derived of the master seed and its number. Requests are answered from the queue right away, while the event loop
+    itself neither polls nor generates. Test cases found in the DharmaBloomFilter |dedup| are not queued, see
+    DharmaBloomFilter.skip(). Subclasses implement handle() for the protocol.
+    """
+
+    PROTOCOL = None
+
+    def __init__(self, machine, address=("127.0.0.1", 9090), jobs=1, queue_size=64, dedup=None):
+        self.machine = machine
+        self.dedup = dedup
+        self.address = address
+        self.jobs = max(1, jobs)
+        self.queue_size = queue_size
+        self.queue = None
+        self.pool = None
+        self.server = None
+
+    async def produce(self):
+        """Keep the queue filled with test cases, keeping every process of the pool busy."""
+        loop = asyncio.get_running_loop()
+        pending = deque()
+        index = 1
+        while True:
+            while len(pending) < 2 * self.jobs:
+                pending.append((index, loop.run_in_executor(self.pool, _generate_testcase_worker, index)))
+                index += 1
+            n, future = pending.popleft()
+            content = await future
+            if content is None:
+                logging.error("Failed in generating test case %d, stopping server.", n)
+                self.server.close()
+                return
+            if self.dedup is not None and self.dedup.skip(content.encode("utf-8", "surrogatepass")):
+                continue
+            await self.queue.put((n, content))
+
+    async def regenerate(self, index):
+        """Return the test case |index| generated by the pool, next to the queued ones, or None on failure."""
+        return await asyncio.get_running_loop().run_in_executor(self.pool, _generate_testcase_worker, index)
+
+    async def handle(self, reader, writer):
+        raise NotImplementedError('Required method handle() not implemented.')
+
+    async def serve(self):
+        self.queue = asyncio.Queue(self.queue_size)
+        context, initializer, initargs = self.machine.worker_setup()
+        with ProcessPoolExecutor(self.jobs, context, initializer, initargs) as self.pool:
+            try:
+                self.server = await asyncio.start_server(self.handle, *self.address)
+            except OSError as error:
+                logging.error("Unable to start %s server: %s", self.PROTOCOL, error)
+                return
+            producer = asyncio.ensure_future(self.produce())
+            logging.info("Socket server is listening at %s:%d", *self.address)
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+            finally:
+                producer.cancel()
+
+    def start(self):
+        asyncio.run(self.serve())
+
+    def stop(self):
+        if self.server is None:
+            return
+        logging.info("Stopping %s server.", self.PROTOCOL)
+        self.server.close()
+        if self.dedup is not None:
+            self.dedup.report()
+
+
+class DharmaAsyncWebSocketServer(DharmaAsyncServer):
+    """WebSocket server on an asyncio event loop, see DharmaAsyncServer."""
+
+    PROTOCOL = "WebSocket"
+
+    async def handle(self, reader, writer):
+        websocket = AsyncWebSocket(reader, writer)
+        try:
+            await websocket.accept()
+            while True:
+                message = await websocket.receive()
+                if message is None:
+                    break
+                request = parse_message(message[1])
+                if request is None:
+                    continue
+                cases = []
+                for _ in range(request[0]):
+                    n, content = await self.queue.get()
+                    cases.append((n, self.machine.case_seed(self.machine.seed, n), content))
+                await websocket.write_message(*encode_reply(cases, request))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError) as error:
+            logging.debug("WebSocket connection failed: %s", error)
+        finally:
+            writer.close()
+
+
+class DharmaAsyncHTTPServer(DharmaAsyncServer):
+    """HTTP/1.1 server on an asyncio event loop, see DharmaAsyncServer.
+
+    GET /testcase answers with the next test case of the queue, GET /testcase?index=n regenerates the test case
+    numbered n. The number and seed of a test case are sent in the X-Dharma-Index and X-Dharma-Seed headers.
+    Connections are kept alive, hence a browser tab which reloads the page reuses its connection.
+    """
+
+    PROTOCOL = "HTTP"
+    # Seconds an idle connection is kept open.
+    KEEP_ALIVE = 60
+    REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               500: "Internal Server Error"}
+
+    def __init__(self, machine, address=("127.0.0.1", 9090), jobs=1, queue_size=64, dedup=None,
+                 content_type="text/html"):
+        DharmaAsyncServer.__init__(self, machine, address, jobs, queue_size, dedup)
+        self.content_type = content_type
+
+    @staticmethod
+    def parse_request(request):
+        """Return the method, path, query, version and headers of a request."""
+        lines = request.decode("latin-1").split("\r\n")
+        method, target, version = lines[0].split(" ")
+        headers = email.parser.HeaderParser().parsestr("\r\n".join(lines[1:]))
+        url = urllib.parse.urlsplit(target)
+        return method, url.path, urllib.parse.parse_qs(url.query), version, headers
+
+    async def respond(self, request):
+        """Return the status, extra headers and body answering a request."""
+        method, path, query, _, _ = request
+        if path != "/testcase":
+            return 404, {}, b""
+        if method not in ("GET", "HEAD"):
+            return 405, {"Allow": "GET, HEAD"}, b""
+        if "index" in query:
+            try:
+                n = int(query["index"][0])
+            except ValueError:
+                return 400, {}, b""
+            if n < 1:
+                return 400, {}, b""
+            content = await self.regenerate(n)
+            if content is None:
+                return 500, {}, b""
+        else:
+            n, content = await self.queue.get()
+        logging.debug("Serving test case %d", n)
+        headers = {
+            "Content-Type": "%s; charset=utf-8" % self.content_type,
+            "Cache-Control": "no-store",
+            "X-Dharma-Index": str(n),
+            "X-Dharma-Seed": str(self.machine.case_seed(self.machine.seed, n)),
+        }
+        return 200, headers, content.encode("utf-8", "surrogatepass")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.KEEP_ALIVE)
+                except asyncio.TimeoutError:
+                    break
+                try:
+                    request = self.parse_request(request)
+                except ValueError:
+                    status, headers, body = 400, {}, b""
+                    keep_alive = False
+                else:
+                    method, _, _, version, request_headers = request
+                    connection = (request_headers["connection"] or "").lower()
+                    keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+                    length = int(request_headers["content-length"] or 0)
+                    if length:
+                        await reader.readexactly(length)
+                    status, headers, body = await self.respond(request)
+                    if method == "HEAD":
+                        headers["Content-Length"] = str(len(body))
+                        body = b""
+                headers.setdefault("Content-Length", str(len(body)))
+                headers["Connection"] = "keep-alive" if keep_alive else "close"
+                head = "HTTP/1.1 %d %s\r\n" % (status, self.REASONS[status])
+                head += "".join("%s: %s\r\n" % item for item in headers.items())
+                writer.write(head.encode("latin-1") + b"\r\n")
+                if body:
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError) as error:
+            logging.debug("HTTP connection failed: %s", error)
+        finally:
+            writer.close()
@@ -0,0 +1,23 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    """Open a temporary file next to |path| for writing, which replaces |path| once the block completed.
+
+    Other processes reading |path| meanwhile see either the previous or the complete file. If the block fails, the
+    temporary file is removed and |path| left as it was.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as fo:
+            yield fo
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
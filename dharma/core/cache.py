@@ -0,0 +1,59 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import pickle
+import hashlib
+import logging
+
+from dharma.__version__ import __version__
+from dharma.core.atomic import atomic_write
+
+
+class DharmaGrammarCache:
+    """On-disk store of parsed and resolved grammars.
+
+    Entries are keyed by a hash of everything which affects parsing: the Dharma version, the settings, the state of
+    DharmaConst and the name and content of every grammar. Files of %block% and %uri% are loaded while generating,
+    hence changes to them do not affect the entries.
+    """
+
+    FORMAT = 9
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def key(self, settings, consts, sources):
+        digest = hashlib.sha256()
+        digest.update(("%s:%d\0" % (__version__, self.FORMAT)).encode("utf-8"))
+        digest.update(settings.encode("utf-8") + b"\0")
+        digest.update(repr(sorted(consts.items())).encode("utf-8") + b"\0")
+        for namespace, content in sources:
+            digest.update(namespace.encode("utf-8") + b"\0")
+            digest.update(content.encode("utf-8") + b"\0")
+        return digest.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, "%s.pickle" % key)
+
+    def load(self, key):
+        """Return the grammar state stored for |key| or None if there is no valid entry."""
+        filename = self.filename(key)
+        try:
+            with open(filename, "rb") as fo:
+                return pickle.load(fo)
+        except FileNotFoundError:
+            return None
+        except Exception as error:  # pylint: disable=broad-except
+            logging.warning("Unable to load compiled grammars from %s: %s", filename, error)
+            return None
+
+    def store(self, key, state):
+        """Store the grammar state for |key|. Failures are not fatal as the cache is only an optimization."""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # Concurrent instances might read the entry meanwhile.
+            with atomic_write(self.filename(key), "wb") as fo:
+                pickle.dump(state, fo, pickle.HIGHEST_PROTOCOL)
+        except (OSError, pickle.PicklingError, RecursionError) as error:
+            logging.warning("Unable to store compiled grammars in %s: %s", self.path, error)
@@ -0,0 +1,142 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import json
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from dharma.core.atomic import atomic_write
+from dharma.core.extensions import DharmaError
+from dharma.core.instrument import DharmaInstrumentation
+
+
+class DharmaCoverage(DharmaInstrumentation):
+    """Counts how often every alternative of every value, variable and variance has been expanded.
+
+    The counts are collected by instrumented select() methods which install() sets on the grammar objects of the
+    machine, through which both engines choose the alternatives. Counts are saved to a JSON file keyed by ident,
+    adding those of this run to the ones in the file at that time, hence several runs and processes can share a file.
+
+    If |guided|, alternatives outside of leaf mode are chosen with a weight of 1 / (1 + count) instead of uniformly,
+    which favours the ones expanded least so far. A guided test case depends on the counts, hence on the test cases
+    generated before it, and can not be regenerated from its index alone.
+    """
+
+    FORMAT = 1
+
+    def __init__(self, machine, guided=False):
+        DharmaInstrumentation.__init__(self, machine)
+        self.guided = guided
+        self.counts = {obj.ident: [0] * len(obj) for obj in self.objects()}
+        # Counts loaded from or saved to a file, the difference to them is added when saving again.
+        self.base = {ident: list(counts) for ident, counts in self.counts.items()}
+        # The threads of a server count at once.
+        self.lock = threading.Lock()
+
+    def install(self):
+        for obj in self.objects():
+            self.patch(obj, "select", self.wrap_select(obj))
+
+    @staticmethod
+    def weighted(counts, rng):
+        """Return an index of |counts| chosen with a weight of 1 / (1 + count)."""
+        weights = [1.0 / (1 + c) for c in counts]
+        x = rng.random() * sum(weights)
+        for i, weight in enumerate(weights):
+            x -= weight
+            if x < 0:
+                return i
+        return len(weights) - 1
+
+    def wrap_select(self, obj):
+        select = obj.select
+        counts = self.counts[obj.ident]
+        weighted = self.weighted if self.guided else None
+        lock = self.lock
+
+        def covered_select(state):
+            index = select(state)
+            if index is None:
+                return None
+            with lock:
+                if weighted is not None and not state.leaf_mode:
+                    index = weighted(counts, state.random)
+                counts[index] += 1
+            return index
+
+        return covered_select
+
+    def read(self, path):
+        """Return the counts stored in the file at |path|, an empty dict if there is none."""
+        try:
+            with open(os.path.expanduser(path)) as fo:
+                data = json.load(fo)
+        except FileNotFoundError:
+            return {}
+        except (IOError, ValueError) as error:
+            raise DharmaError("Unable to read coverage from %s: %s" % (path, error)) from error
+        if not isinstance(data, dict) or data.get("format") != self.FORMAT:
+            raise DharmaError("Unable to read coverage from %s: unknown format" % path)
+        return data["objects"]
+
+    def load(self, path):
+        """Add the counts stored in the file at |path|. Counts of objects whose number of alternatives changed since
+        are ignored.
+        """
+        for ident, stored in self.read(path).items():
+            counts = self.counts.get(ident)
+            if counts is None:
+                continue
+            if len(stored) != len(counts):
+                logging.debug("Ignoring coverage of %s, its alternatives changed", ident)
+                continue
+            for i, n in enumerate(stored):
+                counts[i] += n
+                self.base[ident][i] += n
+
+    def save(self, path):
+        """Add the counts collected since the last load() or save() to those in the file at |path|."""
+        path = os.path.expanduser(path)
+        lock = None
+        try:
+            if fcntl is not None:
+                lock = open(path + ".lock", "w")
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            stored = self.read(path)
+            with self.lock:
+                counts = {ident: list(counts) for ident, counts in self.counts.items()}
+            for ident, current in counts.items():
+                added = [n - b for n, b in zip(current, self.base[ident])]
+                previous = stored.get(ident)
+                if previous is not None and len(previous) == len(current):
+                    added = [n + p for n, p in zip(added, previous)]
+                stored[ident] = added
+            # Other processes might read the file meanwhile.
+            with atomic_write(path) as fo:
+                json.dump({"format": self.FORMAT, "objects": stored}, fo, sort_keys=True)
+        except OSError as error:
+            raise DharmaError("Unable to write coverage to %s: %s" % (path, error)) from error
+        finally:
+            if lock is not None:
+                lock.close()
+        self.base = counts
+
+    def uncovered(self):
+        """Yield the ident and index of every alternative which has not been expanded."""
+        for ident, counts in self.counts.items():
+            for i, n in enumerate(counts):
+                if not n:
+                    yield ident, i
+
+    def report(self):
+        alternatives = sum(len(counts) for counts in self.counts.values())
+        covered = alternatives - sum(1 for _ in self.uncovered())
+        objects = sum(1 for counts in self.counts.values() if all(counts))
+        return "Covered %d of %d alternatives (%.2f%%), all alternatives of %d of %d objects" % (
+            covered, alternatives, 100.0 * covered / max(1, alternatives), objects, len(self.counts))
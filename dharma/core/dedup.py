@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import hashlib
+import logging
+import math
+import threading
+
+
+class DharmaBloomFilter:  # pylint: disable=too-many-instance-attributes
+    """Set of test case hashes of bounded size, which may report a new test case as duplicate.
+
+    The filter is sized for |capacity| test cases at a false positive rate of |error_rate|. Beyond that capacity the
+    rate grows. Every test case sets |k| bits, derived of a single BLAKE2b digest by double hashing.
+    """
+
+    # Duplicates in a row after which servers serve a duplicate, as the grammar seems to have no unique test cases left.
+    MAX_MISSES = 1000
+
+    def __init__(self, capacity, error_rate=0.001):
+        if not 0 < error_rate < 1:
+            raise ValueError("error rate must be between 0 and 1")
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.k = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.lock = threading.Lock()
+        self.seen = 0
+        self.duplicates = 0
+        # Duplicates in a row, counted by skip().
+        self.misses = 0
+
+    @staticmethod
+    def hashes(data):
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+    def insert(self, h1, h2):
+        """Set the bits of the hashes |h1| and |h2|, return True if all of them were set before. Requires the lock."""
+        bits, size = self.bits, self.size
+        found = True
+        for i in range(self.k):
+            n = (h1 + i * h2) % size
+            if not bits[n >> 3] & (1 << (n & 7)):
+                found = False
+                bits[n >> 3] |= 1 << (n & 7)
+        self.seen += 1
+        if found:
+            self.duplicates += 1
+        elif self.seen - self.duplicates == self.capacity + 1:
+            logging.warning("Deduplication exceeds its capacity of %d test cases, "
+                            "more unique test cases will be taken for duplicates", self.capacity)
+        return found
+
+    def add(self, data):
+        """Add the bytes |data|, return True if they were (probably) added before."""
+        hashes = self.hashes(data)
+        with self.lock:
+            return self.insert(*hashes)
+
+    def skip(self, data):
+        """Add the bytes |data| of a test case to serve, return True if it is to be skipped as duplicate. Once
+        MAX_MISSES duplicates came in a row, duplicates are served until a unique test case comes again.
+        """
+        hashes = self.hashes(data)
+        with self.lock:
+            if not self.insert(*hashes):
+                self.misses = 0
+                return False
+            self.misses += 1
+            if self.misses < self.MAX_MISSES:
+                return True
+            if self.misses == self.MAX_MISSES:
+                logging.warning("%d duplicates in a row, serving duplicates as no unique test cases seem to be left",
+                                self.MAX_MISSES)
+            return False
+
+    def report(self):
+        if self.seen:
+            logging.info("Skipped %d duplicates of %d test cases (%.2f%%)",
+                         self.duplicates, self.seen, 100.0 * self.duplicates / self.seen)
@@ -1,24 +1,59 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import io
 import os
 import re
 import sys
+import time
+import random
+import hashlib
 import logging
+import tempfile
+import multiprocessing
 from string import Template
 from itertools import chain
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 if sys.version_info[0] == 2:
     from extensions import *  # pylint: disable=E0401,W0401
+    from alias import DharmaAliasTable  # pylint: disable=E0401
+    from sinks import SINKS, DharmaThreadedSink  # pylint: disable=E0401
 else:
     from dharma.core.extensions import *  # pylint: disable=W0401,W0614
+    from dharma.core.alias import DharmaAliasTable
+    from dharma.core.sinks import SINKS, DharmaThreadedSink
 
 
-class GenState:
-    def __init__(self):
+class GenState:  # pylint: disable=too-many-instance-attributes
+    """State of the generation of a single test case.
+
+    All state which changes while generating lives here, next to the random generator: the variables defined so
+    far, the leaf mode of the current variance, the number of expanded nodes and the approximate size of the output
+    in characters. The grammar objects are only read, hence one machine can generate in several threads at once.
+
+    Once the number of nodes or the size exceeds its budget, MAX_NODES or MAX_OUTPUT_BYTES, the state is exhausted:
+    the generator stays in leaf mode, repeats are expanded once and no further variances are added.
+    """
+
+    def __init__(self, rng):
+        self.random = rng
+        self.variables = {}
         self.leaf_mode = False
         self.leaf_trigger = 0
+        self.nodes = 0
+        self.size = 0
+        self.max_nodes = DharmaConst.MAX_NODES or float("inf")
+        self.max_size = DharmaConst.MAX_OUTPUT_BYTES or float("inf")
+        self.exhausted = False
+
+    def reset(self):
+        """Prepare for the next variance."""
+        self.leaf_mode = self.exhausted
+        self.leaf_trigger = 0
+
+    def exhaust(self):
+        self.exhausted = self.leaf_mode = True
 
 
 class String:
@@ -29,9 +64,24 @@ class String:
         self.value = value
 
     def generate(self, state):
+        state.size += len(self.value)
         return self.value
 
 
+class Weight:
+    """Weight of an alternative of a value or variance, given by a leading %weight%(n)."""
+
+    def __init__(self, weight, parent):
+        self.parent = parent
+        self.column = parent.machine.column
+        try:
+            self.weight = float(weight) if "." in weight else int(weight)
+        except ValueError:
+            raise DharmaError("%s: Malformed 'weight' %s" % (parent.machine.id(), weight)) from None
+        if self.weight <= 0:
+            raise DharmaError("%s: Non-positive 'weight' %s" % (parent.machine.id(), weight))
+
+
 class ValueXRef:
     """Generator class for +value+ cross references."""
 
@@ -44,8 +94,8 @@ class ValueXRef:
         try:
             ref = self.parent.value_xref[self.value]
         except KeyError:
-            logging.error("Value xref inconsistency in %s looking for %s", self.parent.ident, self.value)
-            sys.exit(-1)
+            raise DharmaError("Value xref inconsistency in %s looking for %s"
+                              % (self.parent.ident, self.value)) from None
         return ref.generate(state)
 
 
@@ -61,8 +111,8 @@ class VariableXRef:
         try:
             ref = self.parent.variable_xref[self.value]
         except KeyError:
-            logging.error("Variable xref inconsistency in %s looking for %s", self.parent.ident, self.value)
-            sys.exit(-1)
+            raise DharmaError("Variable xref inconsistency in %s looking for %s"
+                              % (self.parent.ident, self.value)) from None
         return ref.generate(state)
 
 
@@ -78,12 +128,12 @@ class ElementXRef:
         try:
             ref = self.parent.element_xref[self.value]
         except KeyError:
-            logging.error("Element xref inconsistency in %s looking for %s", self.parent.ident, self.value)
-            sys.exit(-1)
+            raise DharmaError("Element xref inconsistency in %s looking for %s"
+                              % (self.parent.ident, self.value)) from None
         return ref.generate(state)
 
 
-class DharmaObject(list):
+class DharmaObject(list):  # pylint: disable=too-many-instance-attributes
     """Base object of which Dharma section classes inherit from."""
 
     def __init__(self, ident, machine):
@@ -95,6 +145,9 @@ class DharmaObject(list):
         self.element_xref = {}
         self.namespace = machine.namespace
         self.lineno = machine.lineno
+        # Weights of the alternatives, None as long as all of them weigh 1, and a DharmaAliasTable to sample them.
+        self.weights = None
+        self.alias_table = None
 
     def id(self):  # pylint: disable=invalid-name
         return "Line %d [%s]" % (self.lineno, self.namespace)
@@ -106,6 +159,24 @@ class DharmaObject(list):
     def eval(tokens, state):
         return "".join(token.generate(state) for token in tokens)
 
+    def weigh(self, weight):
+        """Set the |weight| of the alternative appended last."""
+        if self.weights is None:
+            if weight == 1:
+                return
+            self.weights = [1] * (len(self) - 1)
+        self.weights.append(weight)
+
+    def calculate_alias_tables(self):
+        if self.weights is not None:
+            self.alias_table = DharmaAliasTable(self.weights)
+
+    def choose(self, state):
+        """Return the index of a random alternative, in proportion to the weights if any."""
+        if self.alias_table is None:
+            return state.random.randrange(len(self))
+        return self.alias_table.sample(state.random)
+
 
 class DharmaValue(DharmaObject):
     """Dharma class which manages the |value| section of a grammar."""
@@ -113,20 +184,24 @@ class DharmaValue(DharmaObject):
     def __init__(self, ident, machine):
         DharmaObject.__init__(self, ident, machine)
         self.leaf = []
-        self.leaf_path = []
-        self.path_idents = set()
-        self.minimized = None
+        self.leaf_distance = None
+        self.minimized = ()
+        self.leaf_table = None
+        self.minimized_table = None
 
     def n_xrefs(self, value):
         repeats, n = False, 0
         for t in value:
             if isinstance(t, ValueXRef):
                 n += 1
-                if t.value not in self.path_idents:
+                if self.value_xref[t.value].leaf_distance is None:
                     return False, None, None
             elif isinstance(t, MetaRepeat):
                 repeats = True
-                n += self.n_xrefs(t.repeat)[2]
+                is_leaf_path, _, nested = self.n_xrefs(t.repeat)
+                if not is_leaf_path:
+                    return False, None, None
+                n += nested
         return True, repeats, max(1, min(n, 8))  # constrain within [1, 8]
 
     def append(self, value):
@@ -134,41 +209,63 @@ class DharmaValue(DharmaObject):
         for t in value:
             if isinstance(t, (MetaRepeat, ValueXRef)):
                 return
-        self.leaf.append(value)
-
-    def generate(self, state):  # pylint: disable=too-many-branches
+        self.leaf.append(len(self) - 1)
+
+    def minimize(self):
+        """Return the indices of the alternatives to favour in leaf mode for a value without leaves."""
+        n_refs_groups = {}
+        have_non_repeats = False
+        for i, v in enumerate(self):
+            is_leaf_path, repeats, n_xrefs = self.n_xrefs(v)
+            if not is_leaf_path:
+                continue
+            if not repeats:
+                if not have_non_repeats:
+                    n_refs_groups = {}
+                    have_non_repeats = True
+            if not repeats or not have_non_repeats:
+                n_refs_groups.setdefault(n_xrefs, []).append(i)
+        for _, v in sorted(n_refs_groups.items()):
+            return v
+        return None
+
+    def select(self, state):
+        """Return the index of the alternative to expand next, favouring leaves once in leaf mode."""
+        state.nodes += 1
+        if state.nodes > state.max_nodes or state.size > state.max_size:
+            state.exhaust()
         if not state.leaf_mode:
             state.leaf_trigger += 1
             if state.leaf_trigger > DharmaConst.LEAF_TRIGGER:
                 state.leaf_mode = True
         if not self:
-            return ""
+            return None
         if state.leaf_mode and self.leaf:
-            value = random.choice(self.leaf)
-        elif state.leaf_mode:  # favour non-repeating
-            if self.minimized is None:
-                n_refs_groups = {}
-                have_non_repeats = False
-                for v in self:
-                    is_leaf_path, repeats, n_xrefs = self.n_xrefs(v)
-                    if not is_leaf_path:
-                        continue
-                    if not repeats:
-                        if not have_non_repeats:
-                            n_refs_groups = {}
-                            have_non_repeats = True
-                    if not repeats or not have_non_repeats:
-                        n_refs_groups.setdefault(n_xrefs, []).append(v)
-                for _, v in sorted(n_refs_groups.items()):
-                    self.minimized = v
-                    break
-                if not self.minimized:
-                    logging.error("No path to leaf in force-leaf mode in value %s", self.ident)
-                    sys.exit(-1)
-            value = random.choice(self.minimized)
-        else:
-            value = random.choice(self)
-        return self.eval(value, state)
+            if self.leaf_table is not None:
+                return self.leaf[self.leaf_table.sample(state.random)]
+            return state.random.choice(self.leaf)
+        if state.leaf_mode:  # favour non-repeating
+            if not self.minimized:
+                raise DharmaError("No path to leaf in force-leaf mode in value %s" % self.ident)
+            if self.minimized_table is not None:
+                return self.minimized[self.minimized_table.sample(state.random)]
+            return state.random.choice(self.minimized)
+        return self.choose(state)
+
+    def calculate_alias_tables(self):
+        """Build the alias tables of all alternatives and of those favoured in leaf mode, if weighted."""
+        DharmaObject.calculate_alias_tables(self)
+        if self.weights is not None:
+            if self.leaf:
+                self.leaf_table = DharmaAliasTable([self.weights[i] for i in self.leaf])
+            if self.minimized:
+                self.minimized_table = DharmaAliasTable([self.weights[i] for i in self.minimized])
+
+    def generate(self, state):
+        index = self.select(state)
+        if index is None:
+            return ""
+        return self.eval(self[index], state)
 
 
 class DharmaVariable(DharmaObject):
@@ -177,39 +274,130 @@ class DharmaVariable(DharmaObject):
     def __init__(self, ident, machine):
         DharmaObject.__init__(self, ident, machine)
         self.var = ident
-        self.count = 0
-        self.default = ""
 
-    def clear(self):
-        self.count = 0
-        self.default = ""
+    def defaults(self, state):
+        """Return the definitions of the variables defined so far in |state|."""
+        return state.variables.get(self.ident, ())
+
+    def reuse(self, state):
+        """Return the name of an already defined variable or None if a new one has to be defined."""
+        count = len(self.defaults(state))
+        if count >= state.random.randint(DharmaConst.VARIABLE_MIN, DharmaConst.VARIABLE_MAX):
+            element_name = "%s%d" % (self.var, state.random.randint(1, count))
+            state.size += len(element_name)
+            return element_name
+        return None
+
+    def select(self, state):
+        """Return the index of the (prefix, suffix) alternative defining a new variable."""
+        state.nodes += 1
+        return state.random.randrange(len(self))
+
+    def define(self, prefix, suffix, state):
+        """Add a new default variable from the evaluated prefix and suffix and return its name."""
+        defaults = state.variables.setdefault(self.ident, [])
+        element_name = "%s%d" % (self.var, len(defaults) + 1)
+        defaults.append("%s%s%s\n" % (prefix, element_name, suffix))
+        state.size += 2 * len(element_name)
+        return element_name
 
     def generate(self, state):
         """Return a random variable if any, otherwise create a new default variable."""
-        if self.count >= random.randint(DharmaConst.VARIABLE_MIN, DharmaConst.VARIABLE_MAX):
-            return "%s%d" % (self.var, random.randint(1, self.count))
-        var = random.choice(self)
-        prefix = self.eval(var[0], state)
-        suffix = self.eval(var[1], state)
-        self.count += 1
-        element_name = "%s%d" % (self.var, self.count)
-        self.default += "%s%s%s\n" % (prefix, element_name, suffix)
-        return element_name
+        element_name = self.reuse(state)
+        if element_name is not None:
+            return element_name
+        prefix, suffix = self[self.select(state)]
+        return self.define(self.eval(prefix, state), self.eval(suffix, state), state)
 
 
 class DharmaVariance(DharmaObject):
     """Dharma class which manages the |variance| section of a grammar."""
 
+    def select(self, state):
+        """Return the index of the alternative to expand."""
+        return self.choose(state)
+
     def generate(self, state):
-        return self.eval(random.choice(self), state)
+        return self.eval(self[self.select(state)], state)
+
+
+def _init_testcase_worker(machine, consts, recursion_limit):
+    """Install the parsed machine, its constants and the recursion limit of the parent in a test case worker process.
+    """
+    global _WORKER_MACHINE  # pylint: disable=global-statement
+    sys.setrecursionlimit(recursion_limit)
+    DharmaConst.restore(consts)
+    _WORKER_MACHINE = machine
+
+
+def _write_testcases_worker(task):
+    """Write a range of test cases in a worker process, logging and reporting failure instead of raising."""
+    try:
+        _WORKER_MACHINE.write_testcases(*task)
+    except DharmaError as error:
+        logging.error("%s", error)
+        return False
+    return True
+
+
+def _encode_testcases_worker(task):
+    """Generate a range of test cases in a worker process as UTF-8, returning None on failure."""
+    try:
+        return [(n, _WORKER_MACHINE.encode_testcase(n)) for n in range(*task)]
+    except DharmaError as error:
+        logging.error("%s", error)
+        return None
+
+
+def _generate_testcase_worker(index):
+    """Generate the test case |index| in a worker process, returning None on failure."""
+    try:
+        return _WORKER_MACHINE.generate_content(index)
+    except DharmaError as error:
+        logging.error("%s", error)
+        return None
+
+
+_WORKER_MACHINE = None
 
 
 class DharmaMachine:  # pylint: disable=too-many-instance-attributes
-    def __init__(self, prefix="", suffix="", template=""):
+    # Characters of variance output kept in memory before spilling to a temporary file, and the read size of it.
+    SPOOL_SIZE = 1 << 22
+    SPOOL_CHUNK = 1 << 16
+    CONTENT_MARKER = "\0testcase_content\0"
+    # Indented and empty lines, the bulk of every grammar, are recognized by scan_line() without this pattern.
+    grammar_level_registry = re.compile(r"""^(
+        (?P<comment>%%%).*|
+        %const%\s*(?P<const>[A-Z_]+)\s*:=\s*(?P<value>.*)|
+        %section%\s*:=\s*(?P<section>value|variable|variance)|
+        (?P<ident>[a-zA-Z0-9_]+)\s*:=\s*|
+        (?P<empty>\s*)|
+        (\t|[ ]+)(?P<assign>.*)
+    )$""", re.VERBOSE | re.IGNORECASE)
+    xref_registry = re.compile(r"""(
+        (?P<type>\+|!|@)(?P<xref>[a-zA-Z0-9:_]+)(?P=type)|
+        %uri%\(\s*(?P<uri>.*?)\s*\)|
+        %repeat%\(\s*(?P<repeat>.+?)\s*(,\s*"(?P<separator>.*?)")?\s*(,\s*(?P<nodups>nodups))?\s*\)|
+        %block%\(\s*(?P<block>.*?)\s*\)|
+        %range%\((?P<start>.+?)-(?P<end>.+?)\)|
+        %choice%\(\s*(?P<choices>.+?)\s*\)|
+        %weight%\(\s*(?P<weight>.*?)\s*\)
+    )""", re.VERBOSE | re.DOTALL)
+    # Bounds of distinct expansions beyond which they are taken as unbounded.
+    SPACE_LIMIT = 1 << 32
+    # Every match of xref_registry starts with one of these characters.
+    xref_hint = re.compile(r"[+!@%]")
+
+    def __init__(self, prefix="", suffix="", template="", seed=0, rng=random.Random):  # pylint: disable=too-many-arguments
+        """|rng| is the class of the random generators, random.Random or one with the same methods, e.g. those in
+        dharma.core.rng. It is instantiated with a seed for the machine and for every test case with an index.
+        """
         self.section = None
         self.level = "top"
         self.namespace = ""
         self.lineno = 0
+        self.column = 0
         self.current_obj = None
         self.value = {}
         self.variable = OrderedDict()
@@ -217,77 +405,111 @@ class DharmaMachine:  # pylint: disable=too-many-instance-attributes
         self.prefix = prefix
         self.suffix = suffix
         self.template = template
+        self.engine = None
+        self.seed = seed
+        self.rng = rng
+        self.random = rng(seed)
         self.consts_set = {}
+        self.settings_source = ""
+        self.load_times = OrderedDict()
         self.default_grammars = ["../grammars/common.dg"]
-        self.grammar_level_registry = r"""^(
-            (?P<comment>%%%).*|
-            %const%\s*(?P<const>[A-Z_]+)\s*:=\s*(?P<value>.*)|
-            %section%\s*:=\s*(?P<section>value|variable|variance)|
-            (?P<ident>[a-zA-Z0-9_]+)\s*:=\s*|
-            (?P<empty>\s*)|
-            (\t|[ ]+)(?P<assign>.*)
-        )$"""
-        self.xref_registry = r"""(
-            (?P<type>\+|!|@)(?P<xref>[a-zA-Z0-9:_]+)(?P=type)|
-            %uri%\(\s*(?P<uri>.*?)\s*\)|
-            %repeat%\(\s*(?P<repeat>.+?)\s*(,\s*"(?P<separator>.*?)")?\s*(,\s*(?P<nodups>nodups))?\s*\)|
-            %block%\(\s*(?P<block>.*?)\s*\)|
-            %range%\((?P<start>.+?)-(?P<end>.+?)\)|
-            %choice%\(\s*(?P<choices>.+?)\s*\)
-        )"""
 
     def process_settings(self, settings):
         """A lazy way of feeding Dharma with configuration settings."""
         logging.debug("Using configuration from: %s", settings.name)
-        exec(compile(settings.read(), settings.name, 'exec'), globals(), locals())  # pylint: disable=exec-used
+        self.apply_settings(settings.read(), settings.name)
+
+    def apply_settings(self, source, name="<settings>"):
+        """Execute the configuration settings in |source|, the content of a settings file named |name|."""
+        self.settings_source = source
+        try:
+            code = compile(source, name, 'exec')
+        except SyntaxError as error:
+            raise DharmaError("%s: Invalid settings: %s" % (name, error)) from error
+        exec(code, globals(), locals())  # pylint: disable=exec-used
 
     def set_namespace(self, name):
         self.namespace = name
         self.lineno = 0
+        self.column = 0
 
     def id(self):  # pylint: disable=invalid-name
+        if self.column:
+            return "Line %d:%d [%s]" % (self.lineno, self.column, self.namespace)
         return "Line %d [%s]" % (self.lineno, self.namespace)
 
+    def scan_line(self, line):
+        """Lexical stage of the parser: classify a grammar line.
+
+        Returns a tuple (kind, payload, column) where kind is one of comment, const, section, ident, empty, assign or
+        None for an unrecognized line and column is the zero-based offset of the payload.
+        """
+        if line.endswith("\n"):
+            line = line[:-1]
+        if not line or line.isspace():
+            return "empty", None, 0
+        if line[0] == "\t":
+            return "assign", line[1:], 1
+        if line[0] == " ":
+            assign = line.lstrip(" ")
+            return "assign", assign, len(line) - len(assign)
+        m = self.grammar_level_registry.match(line)
+        if m is None:
+            return None, None, 0
+        if m.group("comment"):
+            return "comment", None, 0
+        if m.group("const"):
+            return "const", m.group("const", "value"), m.start("const")
+        if m.group("section"):
+            return "section", m.group("section").lower(), m.start("section")
+        if m.group("ident"):
+            return "ident", m.group("ident"), 0
+        return None, None, 0
+
     def parse_line(self, line):
         self.lineno += 1
-        m = re.match(self.grammar_level_registry, line, re.VERBOSE | re.IGNORECASE)
-        if m is None:
-            pass
-        elif m.group("comment"):
+        kind, payload, column = self.scan_line(line)
+        self.column = column + 1
+        if kind == "comment":
             return
-        elif m.group("const"):
-            self.handle_const(*m.group("const", "value"))
+        if kind == "const":
+            self.handle_const(*payload)
             return
-        elif m.group("section"):
+        if kind == "section":
             self.handle_empty_line()
-            self.section = m.group("section").lower()
+            self.section = payload
             return
-        elif m.group("empty") is not None:
+        if kind == "empty":
             self.handle_empty_line()
             return
+        if kind is None:
+            pass
         elif self.section is None:
-            logging.error("%s: Non-empty line in void section", self.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Non-empty line in void section" % self.id())
         elif self.level == "top":
-            self.handle_top_level(m.group("ident"))
+            self.handle_top_level(payload if kind == "ident" else None)
             return
         elif self.level == "assign":
-            self.handle_assign_level(m.group("assign"))
+            self.handle_assign_level(payload if kind == "assign" else None)
             return
-        logging.error("%s: Unhandled line", self.id())
-        sys.exit(-1)
+        raise DharmaError("%s: Unhandled line" % self.id())
 
     def handle_const(self, const, value):
         if not hasattr(DharmaConst, const):
-            logging.error("%s: Trying to set non-existent constant", self.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Trying to set non-existent constant" % self.id())
         orig = self.consts_set.get(const)
+        if not value:
+            raise DharmaError("%s: Empty value of constant %s" % (self.id(), const))
         if value[0] == '"':
-            assert value[-1] == '"'
+            if len(value) < 2 or value[-1] != '"':
+                raise DharmaError("%s: Unterminated string value of constant %s" % (self.id(), const))
             value = value[1:-1]
             setattr(DharmaConst, const, value)
         else:
-            setattr(DharmaConst, const, float(value) if "." in value else int(value))
+            try:
+                setattr(DharmaConst, const, float(value) if "." in value else int(value))
+            except ValueError:
+                raise DharmaError("%s: Invalid value of constant %s: %s" % (self.id(), const, value)) from None
         if orig is not None and getattr(DharmaConst, const) != orig:
             logging.warning("%s: Overriding constant %s defined by previous grammar", self.id(), const)
         self.consts_set[const] = getattr(DharmaConst, const)
@@ -296,8 +518,7 @@ class DharmaMachine:  # pylint: disable=too-many-instance-attributes
         if self.current_obj is None:
             pass
         elif not self.current_obj:
-            logging.error("%s: Empty assignment", self.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Empty assignment" % self.id())
         else:
             self.add_section_object()
         self.level = "top"
@@ -305,40 +526,42 @@ class DharmaMachine:  # pylint: disable=too-many-instance-attributes
 
     def handle_top_level(self, ident):
         if ident is None:
-            logging.error("%s: Top level syntax error", self.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Top level syntax error" % self.id())
         try:
             assign_type = {"value": DharmaValue,
                            "variable": DharmaVariable,
                            "variance": DharmaVariance}[self.section]
         except KeyError:
-            logging.error("%s: Invalid state for top-level", self.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Invalid state for top-level" % self.id()) from None
         self.current_obj = assign_type(ident, self)
         self.level = "assign"
 
     def handle_assign_level(self, assign):
         if assign is None:
-            logging.error("%s: Assign level syntax error", self.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Assign level syntax error" % self.id())
         try:
             parse_assign = {"value": self.parse_assign_value,
                             "variable": self.parse_assign_variable,
                             "variance": self.parse_assign_variance}[self.section]
         except KeyError:
-            logging.error("%s: Invalid state for assignment", self.id())
-            sys.exit(-1)
-        parse_assign(self.parse_xrefs(assign))
+            raise DharmaError("%s: Invalid state for assignment" % self.id()) from None
+        parse_assign(self.parse_xrefs(assign, self.column - 1))
 
-    def parse_xrefs(self, token):
-        """Search token for +value+ and !variable! style references. Be careful to not xref a new variable.
+    def parse_xrefs(self, token, column=0):  # pylint: disable=too-many-branches
+        """Search token for +value+ and !variable! style references. Be careful to not xref a new variable. |column|
+        is the zero-based column of |token| in its line, errors in an extension report the column of the extension.
         """
-        out, end = [], 0
         token = token.replace("\\n", "\n")
-        for m in re.finditer(self.xref_registry, token, re.VERBOSE | re.DOTALL):
+        if token and self.xref_hint.search(token) is None:
+            return [String(token, self.current_obj)]
+        payload_column = self.column
+        out, end = [], 0
+        for m in self.xref_registry.finditer(token):
             if m.start(0) > end:
                 out.append(String(token[end:m.start(0)], self.current_obj))
             end = m.end(0)
+            # Every escaped newline before the match took two characters in the line.
+            self.column = column + m.start(0) + token.count("\n", 0, m.start(0)) + 1
             if m.group("type"):
                 xref_type = {"+": ValueXRef,
                              "!": VariableXRef,
@@ -349,29 +572,46 @@ class DharmaMachine:  # pylint: disable=too-many-instance-attributes
                 out.append(MetaURI(path, self.current_obj))
             elif m.group("repeat") is not None:
                 repeat, separator, nodups = m.group("repeat", "separator", "nodups")
-                if separator is None:
-                    separator = ""
-                if nodups is None:
-                    nodups = ""
-                out.append(MetaRepeat(self.parse_xrefs(repeat), separator, nodups, self.current_obj))
+                repeat = self.parse_xrefs(repeat, column + m.start("repeat") + token.count("\n", 0, m.start("repeat")))
+                out.append(MetaRepeat(repeat, separator or "", nodups or "", self.current_obj))
             elif m.group("block") is not None:
                 path = m.group("block")
                 out.append(MetaBlock(path, self.current_obj))
             elif m.group("choices") is not None:
                 choices = m.group("choices")
                 out.append(MetaChoice(choices, self.current_obj))
+            elif m.group("weight") is not None:
+                out.append(Weight(m.group("weight"), self.current_obj))
             else:
                 startval, endval = m.group("start", "end")
                 out.append(MetaRange(startval, endval, self.current_obj))
         if end < len(token):
             out.append(String(token[end:], self.current_obj))
+        self.column = payload_column
         return out
 
+    def parse_weight(self, tokens):
+        """Split a leading %weight%(n) off the tokens of an alternative, return the weight, 1 if there is none, and
+        the remaining tokens. Whitespace between the weight and the alternative is dropped.
+        """
+        weight = 1
+        if tokens and isinstance(tokens[0], Weight):
+            weight, tokens = tokens[0].weight, tokens[1:]
+            if tokens and isinstance(tokens[0], String):
+                value = tokens[0].value.lstrip()
+                tokens = ([String(value, self.current_obj)] if value else []) + tokens[1:]
+        for token in tokens:
+            if isinstance(token, Weight):
+                self.column = token.column
+                raise DharmaError("%s: 'weight' has to precede the alternative" % self.id())
+        return weight, tokens
+
     def parse_assign_value(self, tokens):
         if not isinstance(self.current_obj, DharmaValue):
-            logging.error("%s: Normal value found in non-normal assignment", self.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Normal value found in non-normal assignment" % self.id())
+        weight, tokens = self.parse_weight(tokens)
         self.current_obj.append(tokens)
+        self.current_obj.weigh(weight)
 
     def parse_assign_variable(self, tokens):
         """
@@ -382,37 +622,35 @@ class DharmaMachine:  # pylint: disable=too-many-instance-attributes
                 dharma.String:      '= new ',
                 dharma.ValueXRef:   'GrammarNS:<ValueName>'
         """
+        if any(isinstance(t, Weight) for t in tokens):
+            raise DharmaError("%s: 'weight' in variable assignment" % self.id())
         for i, token in enumerate(tokens):
             if isinstance(token, ElementXRef):
                 variable = token.value
                 break
         else:
-            logging.error("%s: Variable assignment syntax error", self.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Variable assignment syntax error" % self.id())
         if variable != self.current_obj.ident:
-            logging.error("%s: Variable name mismatch", self.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Variable name mismatch" % self.id())
         if not isinstance(self.current_obj, DharmaVariable):
-            logging.error("%s: Inconsistent object for variable assignment", self.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Inconsistent object for variable assignment" % self.id())
         prefix, suffix = tokens[:i], tokens[i + 1:]  # pylint: disable=undefined-loop-variable
         self.current_obj.append((prefix, suffix))
 
     def parse_assign_variance(self, tokens):
         if not isinstance(self.current_obj, DharmaVariance):
-            logging.error("%s: Inconsistent object for variance assignment", self.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Inconsistent object for variance assignment" % self.id())
+        weight, tokens = self.parse_weight(tokens)
         self.current_obj.append(tokens)
+        self.current_obj.weigh(weight)
 
     def add_section_object(self):
         try:
             section_dict = getattr(self, self.section)
         except AttributeError:
-            logging.error("%s: Inconsistent section value, fatal", self.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Inconsistent section value, fatal" % self.id()) from None
         if self.current_obj.ident in section_dict:
-            logging.error("%s(%s): '%s' gets redefined", self.id(), self.section, self.current_obj.ident)
-            sys.exit(-1)
+            raise DharmaError("%s(%s): '%s' gets redefined" % (self.id(), self.section, self.current_obj.ident))
         section_dict[self.current_obj.ident] = self.current_obj
 
     def resolve_xref(self):
@@ -427,100 +665,332 @@ class DharmaMachine:  # pylint: disable=too-many-instance-attributes
                 msg = "%s: Element reference without a default variable from %s to %s"
                 obj.element_xref.update((x, self.variable[x]) for x in obj.element_xref)
             except KeyError as error:
-                logging.error(msg, self.id(), obj.ident, error.args[0])
-                sys.exit(-1)
+                raise DharmaError(msg % (self.id(), obj.ident, error.args[0])) from error
 
     def calculate_leaf_paths(self):
-        """Build map of reverse xrefs then traverse backwards marking path to leaf for all leaves.
+        """Breadth-first search backwards over the value xrefs from all leaves at once, yielding for every value the
+        least number of value expansions which lead to a value with a leaf alternative, None if there is no such
+        path. This takes time linear in the number of values and xrefs.
+
+        The alternatives to favour in leaf mode are computed here for all values, instead of lazily by concurrent
+        generators, hence the grammars are only read during generation.
         """
         reverse_xref = {}
-        leaves = set()
+        queue = deque()
         for v in self.value.values():
+            v.leaf_distance = None
             if v.leaf:
-                leaves.add(v)
+                v.leaf_distance = 0
+                queue.append(v)
             for xref in v.value_xref:
-                reverse_xref.setdefault(xref, []).append(v.ident)
-        for leaf in leaves:
-            self.calculate_leaf_path(leaf, reverse_xref)
+                reverse_xref.setdefault(xref, []).append(v)
+        while queue:
+            obj = queue.popleft()
+            for xref in reverse_xref.get(obj.ident, ()):
+                if xref.leaf_distance is None:
+                    xref.leaf_distance = obj.leaf_distance + 1
+                    queue.append(xref)
+        for v in self.value.values():
+            v.minimized = () if v.leaf else tuple(v.minimize() or ())
 
-    def calculate_leaf_path(self, leaf, reverse_xref):
-        if leaf.ident not in reverse_xref:
-            return
-        for name in reverse_xref[leaf.ident]:
-            xref = self.value[name]
-            xref.leaf_path.append((leaf.ident, leaf.ident, 0))
-            xref.path_idents.add(leaf.ident)
-            self.propagate_leaf(leaf.ident, xref, {xref}, 1, reverse_xref)
-
-    def propagate_leaf(self, leaf, obj, node_seen, depth, reverse_xref):
-        if obj.ident not in reverse_xref:
-            return
-        for name in reverse_xref[obj.ident]:
-            xref = self.value[name]
-            xref.leaf_path.append((leaf, obj.ident, depth))
-            xref.path_idents.add(obj.ident)
-            if xref in node_seen:
+    def calculate_repeat_spaces(self):
+        """Bound the distinct expansions of every %repeat% with nodups, which stops repeating once all of them
+        occurred, see DistinctExpansions.
+        """
+        spaces = {}
+        for obj in chain(self.value.values(), self.variable.values(), self.variance.values()):
+            alternatives = chain.from_iterable(obj) if isinstance(obj, DharmaVariable) else obj
+            stack = list(alternatives)
+            while stack:
+                for token in stack.pop():
+                    if isinstance(token, MetaRepeat):
+                        if token.nodups:
+                            token.space = self.expansions(token.repeat, token.parent, spaces)
+                        stack.append(token.repeat)
+
+    def expansions(self, tokens, obj, spaces):
+        """Return an upper bound of the distinct strings the |tokens| of |obj| expand to, None if it is unbounded or
+        exceeds SPACE_LIMIT. Bounds of values are memoized in |spaces|, recursive values are unbounded.
+        """
+        n = 1
+        for token in tokens:
+            if isinstance(token, (String, MetaBlock)):
                 continue
-            node_seen.add(xref)
-            self.propagate_leaf(leaf, xref, node_seen, depth + 1, reverse_xref)
-
-    def generate_content(self):
-        """Generates a test case as a string."""
+            if isinstance(token, MetaChoice):
+                m = len(set(token.choices))
+            elif isinstance(token, MetaRange) and token.fmt != "f":
+                m = max(1, token.b - token.a + 1)
+            elif isinstance(token, ValueXRef):
+                value = obj.value_xref[token.value]
+                if value.ident not in spaces:
+                    spaces[value.ident] = None
+                    spaces[value.ident] = self.value_expansions(value, spaces)
+                m = spaces[value.ident]
+            else:
+                return None
+            if m is None or n * m > self.SPACE_LIMIT:
+                return None
+            n *= m
+        return n
+
+    def value_expansions(self, value, spaces):
+        if all(len(tokens) <= 1 and all(isinstance(t, String) for t in tokens) for tokens in value):
+            return len(set(tokens[0].value if tokens else "" for tokens in value))
+        n = 0
+        for tokens in value:
+            m = self.expansions(tokens, value, spaces)
+            if m is None or n + m > self.SPACE_LIMIT:
+                return None
+            n += m
+        return n
+
+    def generate_content(self, index=None, seed=None):
+        """Generates a test case as a string.
+
+        If |index| is given, the test case is generated from its own seed derived of the master seed and |index|,
+        hence any test case can be regenerated in isolation, and test cases with an index can be generated by several
+        threads at once. A |seed| is taken as the seed of the test case as is. Otherwise the random state of the
+        machine continues.
+        """
+        content = io.StringIO()
+        self.generate_stream(content.write, index, seed)
+        return content.getvalue()
+
+    def generate_stream(self, write, index=None, seed=None):
+        """Generates a test case and writes it in chunks through the |write| callable, e.g. the write method of a
+        file, instead of building it as one string. See generate_content() for |index| and |seed|.
+
+        Variances are evaluated into a spool first, which is kept in memory up to SPOOL_SIZE characters, as the
+        default variables they define precede them in the output. The flat engine streams within a variance too,
+        the object engine evaluates every variance into a string. Returns the GenState of the test case, which
+        tells whether it hit the generation budget.
+        """
+        if seed is None and index is not None:
+            seed = self.case_seed(self.seed, index)
+        rng = self.random if seed is None else self.rng(seed)
         # Setup pre-conditions.
         if not self.variance:
-            logging.error("%s: No variance information %s", self.id(), self.variance)
-            sys.exit(-1)
-
-        for var in self.variable.values():
-            var.clear()
-
-        # Handle variances
-        variances = []
-        for _ in range(random.randint(DharmaConst.VARIANCE_MIN, DharmaConst.VARIANCE_MAX)):
-            var = random.choice(list(self.variance.values()))
-            variances.append(DharmaConst.VARIANCE_TEMPLATE % var.generate(GenState()))
-            variances.append("\n")
-
-        # Handle variables
-        variables = []
-        for var in self.variable.values():
-            if var.default:
-                variables.append(DharmaConst.VARIANCE_TEMPLATE % var.default)
-                variables.append("\n")
-
-        # Build content
-        content = "".join(chain([self.prefix], variables, variances, [self.suffix]))
-        if self.template:
-            return Template(self.template).safe_substitute(testcase_content=content)
-        return content
-
-    def generate_testcases(self, path, filetype, count):
-        """Writes out generated test cases to the provided path."""
+            raise DharmaError("%s: No variance information %s" % (self.id(), self.variance))
+
+        state = GenState(rng)
+        with tempfile.SpooledTemporaryFile(self.SPOOL_SIZE, "w+", encoding="utf-8", errors="surrogatepass") as spool:
+            # Handle variances
+            head, tail = (DharmaConst.VARIANCE_TEMPLATE % self.CONTENT_MARKER).split(self.CONTENT_MARKER, 1)
+            variance = list(self.variance.values())
+            for _ in range(rng.randint(DharmaConst.VARIANCE_MIN, DharmaConst.VARIANCE_MAX)):
+                if state.exhausted:
+                    break
+                n = rng.randrange(len(variance))
+                state.reset()
+                spool.write(head)
+                if self.engine is None:
+                    spool.write(variance[n].generate(state))
+                else:
+                    self.engine.generate(n, state, spool.write)
+                spool.write(tail)
+                spool.write("\n")
+
+            # Handle variables
+            variables = []
+            for var in self.variable.values():
+                defaults = var.defaults(state)
+                if defaults:
+                    variables.append(DharmaConst.VARIANCE_TEMPLATE % "".join(defaults))
+                    variables.append("\n")
+
+            # Write content, once for every placeholder in the template
+            pieces = ["", ""]
+            if self.template:
+                pieces = Template(self.template).safe_substitute(testcase_content=self.CONTENT_MARKER)
+                pieces = pieces.split(self.CONTENT_MARKER)
+            write(pieces[0])
+            for piece in pieces[1:]:
+                write(self.prefix)
+                write("".join(variables))
+                spool.seek(0)
+                for chunk in iter(lambda: spool.read(self.SPOOL_CHUNK), ""):
+                    write(chunk)
+                write(self.suffix)
+                write(piece)
+        if state.exhausted:
+            logging.info("Test case %s hit the generation budget at %d nodes and %d characters",
+                         "" if index is None else index, state.nodes, state.size)
+        return state
+
+    @staticmethod
+    def case_seed(seed, index):
+        """Derive the seed of the test case |index| from the master |seed|."""
+        digest = hashlib.sha256(("%d:%d" % (seed, index)).encode("ascii")).digest()
+        return int.from_bytes(digest[:8], "little")
+
+    def worker_setup(self):
+        """Return the multiprocessing context, initializer and its arguments for processes generating test cases of
+        this machine. Processes are forked where possible, which saves pickling the machine. Resources are loaded by
+        every process once it first needs them.
+        """
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        return context, _init_testcase_worker, (self, DharmaConst.snapshot(), sys.getrecursionlimit())
+
+    def write_testcases(self, path, filetype, start, stop):
+        """Writes out the test cases numbered [start, stop) to the provided path."""
+        for n in range(start, stop):
+            filename = os.path.join(path, "%d.%s" % (n, filetype))
+            try:
+                with open(filename, "w") as fo:
+                    self.generate_stream(fo.write, n)
+            except IOError as error:
+                raise DharmaError("Failed in writing test case %s" % filename) from error
+
+    def encode_testcase(self, index):
+        return self.generate_content(index).encode("utf-8", "surrogatepass")
+
+    def encode_testcases(self, start, stop, jobs=1):
+        """Yield the test cases numbered [start, stop) in order as tuples (number, UTF-8 content), optionally
+        generated by a pool of |jobs| processes.
+        """
+        if jobs <= 1 or stop - start <= 1:
+            for n in range(start, stop):
+                yield n, self.encode_testcase(n)
+            return
+        # Small chunks bound the memory held by results which wait for the ones before them.
+        chunk = max(1, min(-(-(stop - start) // (jobs * 4)), 64))
+        tasks = [(n, min(n + chunk, stop)) for n in range(start, stop, chunk)]
+        context, initializer, initargs = self.worker_setup()
+        logging.debug("Generating %d test cases using %d processes", stop - start, jobs)
+        with context.Pool(jobs, initializer, initargs) as pool:
+            for cases in pool.imap(_encode_testcases_worker, tasks):
+                if cases is None:
+                    raise DharmaError("Failed in generating test cases")
+                yield from cases
+
+    def sink_testcases(self, path, filetype, start, stop, jobs=1, sink="batch", threaded=False, dedup=None):
+        """Writes out the test cases numbered [start, stop) through the sink named |sink| in SINKS, optionally
+        from a background thread. Test cases found in the DharmaBloomFilter |dedup| are skipped.
+        """
+        try:
+            out = SINKS[sink](path, filetype, start, stop)
+            if threaded:
+                out = DharmaThreadedSink(out)
+            try:
+                for n, data in self.encode_testcases(start, stop, jobs):
+                    if dedup is not None and dedup.add(data):
+                        continue
+                    out.write(n, data)
+            finally:
+                out.close()
+        except (OSError, ValueError) as error:
+            raise DharmaError("Failed in writing test cases to %s: %s" % (path, error)) from error
+
+    def generate_testcases(self, path, filetype, count, jobs=1, start=1, sink="files", threaded=False,
+                           dedup=None):  # pylint: disable=too-many-arguments
+        """Writes out |count| generated test cases numbered from |start| to the provided path, optionally using a
+        pool of |jobs| processes.
+
+        With the default |sink| "files", not |threaded| and no |dedup| filter every test case is streamed into a file
+        of its own, otherwise the test cases are generated as a whole and written through the named sink, see
+        sink_testcases().
+        Duplicates are skipped, hence their numbers are missing from the output.
+        """
         path = path.rstrip("/")
         try:
             os.makedirs(path, exist_ok=True)
         except OSError as error:
-            logging.error("Unable to create folder for test cases: %s", error)
-            sys.exit(-1)
-        for n in range(count):
-            filename = os.path.join(path, "%d.%s" % (n + 1, filetype))
-            try:
-                with open(filename, "w") as fo:
-                    fo.write(self.generate_content())
-            except IOError:
-                logging.error("Failed in writing test case %s", filename)
-                sys.exit(-1)
-
-    def process_grammars(self, grammars):
-        """Process provided grammars by parsing them into Python objects."""
-        for path in self.default_grammars:
-            grammars.insert(0, open(os.path.relpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                                                                 os.path.normcase(path)))))
+            raise DharmaError("Unable to create folder for test cases: %s" % error) from error
+        if sink != "files" or threaded or dedup is not None:
+            self.sink_testcases(path, filetype, start, start + count, jobs, sink, threaded, dedup)
+            return
+        if jobs <= 1 or count <= 1:
+            self.write_testcases(path, filetype, start, start + count)
+            return
+        # Every test case is seeded by its own number, hence the split does not affect the output.
+        chunk = max(1, -(-count // (jobs * 4)))
+        stop = start + count
+        tasks = [(path, filetype, n, min(n + chunk, stop)) for n in range(start, stop, chunk)]
+        context, initializer, initargs = self.worker_setup()
+        logging.debug("Generating %d test cases using %d processes", count, jobs)
+        with context.Pool(jobs, initializer, initargs) as pool:
+            if not all(pool.imap_unordered(_write_testcases_worker, tasks)):
+                raise DharmaError("Failed in writing test cases to %s" % path)
+
+    def grammar_state(self):
+        """Return the parsed and resolved grammars in a form which can be stored by DharmaGrammarCache."""
+        return {
+            "value": self.value,
+            "variable": self.variable,
+            "variance": self.variance,
+            "consts": DharmaConst.snapshot(),
+            "consts_set": self.consts_set,
+        }
+
+    def restore_grammar_state(self, state):
+        """Take over grammars previously returned by grammar_state()."""
+        self.value = state["value"]
+        self.variable = state["variable"]
+        self.variance = state["variance"]
+        self.consts_set = state["consts_set"]
+        DharmaConst.restore(state["consts"])
+        for obj in chain(self.value.values(), self.variable.values(), self.variance.values()):
+            obj.machine = self
+
+    def process_grammars(self, grammars, cache=None):
+        """Process provided grammars by parsing them into Python objects.
+
+        If a DharmaGrammarCache is provided as |cache|, the resolved grammars are loaded from it if they have been
+        compiled from identical input before, otherwise they are stored in it after processing.
+        """
+        for path in self.default_grammar_paths():
+            grammars.insert(0, open(path))
+        sources = []
         for fo in grammars:
-            logging.debug("Processing grammar content of %s", fo.name)
-            self.set_namespace(os.path.splitext(os.path.basename(fo.name))[0])
-            for line in fo:
+            logging.debug("Reading grammar content of %s", fo.name)
+            sources.append((os.path.splitext(os.path.basename(fo.name))[0], fo.read()))
+        self.process_sources(sources, cache)
+
+    def default_grammar_paths(self):
+        """Return the absolute paths of the grammars which precede the ones of the user, e.g. common.dg."""
+        base = os.path.dirname(os.path.abspath(__file__))
+        return [os.path.normpath(os.path.join(base, os.path.normcase(path))) for path in self.default_grammars]
+
+    def process_sources(self, sources, cache=None):
+        """Process grammars given as a list of tuples (namespace, content). See process_grammars() for |cache|."""
+        if cache is not None:
+            key = cache.key(self.settings_source, DharmaConst.snapshot(), sources)
+            state = cache.load(key)
+            if state is not None:
+                logging.debug("Using compiled grammars from cache: %s", key)
+                self.restore_grammar_state(state)
+                return
+        self.load_times["parse"] = 0.0
+        for namespace, content in sources:
+            logging.debug("Processing grammar content of %s", namespace)
+            self.set_namespace(namespace)
+            start = time.perf_counter()
+            for line in io.StringIO(content):
                 self.parse_line(line)
             self.handle_empty_line()
+            elapsed = max(time.perf_counter() - start, 1e-9)
+            self.load_times["parse"] += elapsed
+            logging.debug("Parsed %d lines of %s in %.1f ms (%d lines/s)",
+                          self.lineno, namespace, elapsed * 1000, self.lineno / elapsed)
+        self.column = 0
+        start = time.perf_counter()
         self.resolve_xref()
+        self.load_times["resolve"] = time.perf_counter() - start
+        start = time.perf_counter()
         self.calculate_leaf_paths()
+        self.load_times["leaf_paths"] = time.perf_counter() - start
+        start = time.perf_counter()
+        for obj in chain(self.value.values(), self.variance.values()):
+            obj.calculate_alias_tables()
+        self.load_times["alias_tables"] = time.perf_counter() - start
+        start = time.perf_counter()
+        self.calculate_repeat_spaces()
+        self.load_times["repeat_spaces"] = time.perf_counter() - start
+        logging.debug("Resolved xrefs in %.1f ms, leaf paths in %.1f ms, alias tables in %.1f ms and repeat spaces "
+                      "in %.1f ms", self.load_times["resolve"] * 1000, self.load_times["leaf_paths"] * 1000,
+                      self.load_times["alias_tables"] * 1000, self.load_times["repeat_spaces"] * 1000)
+        if cache is not None:
+            cache.store(key, self.grammar_state())
@@ -0,0 +1,166 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from itertools import chain
+
+from dharma.core.dharma import DharmaVariable, ElementXRef, MetaRepeat, String, ValueXRef, VariableXRef
+
+
+class DharmaFlatEngine:
+    """Generation engine which runs a flat program compiled from the resolved grammars of a DharmaMachine.
+
+    Every value, variable and variance gets a slot in an object table. Each of their alternatives is compiled into
+    a tuple of (opcode, operand) pairs in which cross references are resolved to slot numbers and adjacent constant
+    strings are merged. The choices are made by the grammar objects themselves, hence the output is identical to
+    the one of the grammar objects for the same random state. Unlike the grammar objects, the engine does not
+    recurse in Python and is therefore not subject to the recursion limit or the stack size of a thread.
+    """
+
+    STRING, VALUE, VARIABLE, CALL, REPEAT = range(5)
+    (RESUME_APPEND, RESUME_PREFIX, RESUME_SUFFIX, RESUME_REPEAT, RESUME_STREAM, RESUME_STREAM_REPEAT,
+     RESUME_DISTINCT) = range(7)
+    # Number of buffered parts after which streamed output is written.
+    CHUNK_PARTS = 1024
+
+    def __init__(self, machine):
+        self.objects = list(chain(machine.value.values(), machine.variable.values(), machine.variance.values()))
+        slots = {id(obj): slot for slot, obj in enumerate(self.objects)}
+        self.code = []
+        for obj in self.objects:
+            if isinstance(obj, DharmaVariable):
+                alternatives = ((self.compile(prefix, obj, slots), self.compile(suffix, obj, slots))
+                                for prefix, suffix in obj)
+            else:
+                alternatives = (self.compile(tokens, obj, slots) for tokens in obj)
+            self.code.append(tuple(alternatives))
+        self.variances = [slots[id(obj)] for obj in machine.variance.values()]
+
+    def compile(self, tokens, obj, slots):
+        """Compile the tokens of an alternative of |obj| into a tuple of (opcode, operand) pairs."""
+        code = []
+        for token in tokens:
+            if isinstance(token, MetaRepeat):
+                op = (self.REPEAT, (token, self.compile(token.repeat, obj, slots)))
+            elif isinstance(token, String):
+                op = (self.STRING, token.value)
+            elif isinstance(token, ValueXRef):
+                op = (self.VALUE, slots[id(obj.value_xref[token.value])])
+            elif isinstance(token, VariableXRef):
+                op = (self.VARIABLE, slots[id(obj.variable_xref[token.value])])
+            elif isinstance(token, ElementXRef):
+                op = (self.VARIABLE, slots[id(obj.element_xref[token.value])])
+            else:
+                op = (self.CALL, token.generate)
+            if op[0] == self.STRING and code and code[-1][0] == self.STRING:
+                code[-1] = (self.STRING, code[-1][1] + op[1])
+            else:
+                code.append(op)
+        return tuple(code)
+
+    def run(self, code, state, write=None):  # pylint: disable=too-many-branches,too-many-statements
+        """Evaluate a compiled alternative.
+
+        Expansions are tracked on an explicit stack of suspended frames instead of the Python call stack, hence the
+        depth of an expansion is limited by memory only. A frame is resumed with the evaluated string of the frame
+        above it, which it handles according to the kind of expansion it was suspended for.
+
+        If a |write| callable is given, the output is streamed through it in chunks and None is returned. Frames
+        whose output goes straight into the output share a single buffer, only the prefix and suffix of new
+        variables and repetitions without duplicates are evaluated into strings.
+        """
+        objects, table = self.objects, self.code
+        stack = []
+        out = [] if write is not None else None
+        parts, pc = out if write is not None else [], 0
+        while True:
+            if pc < len(code):
+                op, arg = code[pc]
+                pc += 1
+                if op == 0:  # STRING
+                    parts.append(arg)
+                    state.size += len(arg)
+                elif op == 1:  # VALUE
+                    index = objects[arg].select(state)
+                    if index is None:
+                        continue
+                    if parts is out:
+                        stack.append((code, pc, parts, self.RESUME_STREAM, None))
+                        code, pc = table[arg][index], 0
+                    else:
+                        stack.append((code, pc, parts, self.RESUME_APPEND, None))
+                        code, pc, parts = table[arg][index], 0, []
+                elif op == 2:  # VARIABLE
+                    obj = objects[arg]
+                    name = obj.reuse(state)
+                    if name is None:
+                        prefix, suffix = table[arg][obj.select(state)]
+                        stack.append((code, pc, parts, self.RESUME_PREFIX, (obj, suffix)))
+                        code, pc, parts = prefix, 0, []
+                    else:
+                        parts.append(name)
+                elif op == 3:  # CALL
+                    parts.append(arg(state))
+                else:  # REPEAT
+                    meta, body = arg
+                    if meta.nodups:
+                        stack.append((code, pc, parts, self.RESUME_DISTINCT, (body, meta.distinct(state))))
+                        code, pc, parts = body, 0, []
+                    elif parts is out:
+                        stack.append((code, pc, parts, self.RESUME_STREAM_REPEAT, (meta, body, meta.count(state) - 1)))
+                        code, pc = body, 0
+                    else:
+                        stack.append((code, pc, parts, self.RESUME_REPEAT, (meta, body, meta.count(state), [])))
+                        code, pc, parts = body, 0, []
+                continue
+            if parts is out:
+                result = None
+                if len(out) >= self.CHUNK_PARTS or not stack:
+                    write("".join(out))
+                    out.clear()
+            else:
+                result = "".join(parts)
+            if not stack:
+                return result
+            code, pc, parts, resume, data = stack.pop()
+            if resume == self.RESUME_STREAM:
+                pass
+            elif resume == self.RESUME_APPEND:
+                parts.append(result)
+            elif resume == self.RESUME_PREFIX:
+                obj, suffix = data
+                stack.append((code, pc, parts, self.RESUME_SUFFIX, (obj, result)))
+                code, pc, parts = suffix, 0, []
+            elif resume == self.RESUME_SUFFIX:
+                obj, prefix = data
+                parts.append(obj.define(prefix, result, state))
+            elif resume == self.RESUME_STREAM_REPEAT:
+                meta, body, remaining = data
+                if remaining and not state.exhausted:
+                    parts.append(meta.separator)
+                    state.size += len(meta.separator)
+                    stack.append((code, pc, parts, resume, (meta, body, remaining - 1)))
+                    code, pc = body, 0
+            elif resume == self.RESUME_DISTINCT:
+                body, distinct = data
+                if distinct.add(result, state):
+                    stack.append((code, pc, parts, resume, data))
+                    code, pc, parts = body, 0, []
+                else:
+                    parts.append(distinct.join())
+            else:
+                meta, body, count, strings = data
+                strings.append(result)
+                if len(strings) < count and not state.exhausted:
+                    state.size += len(meta.separator)
+                    stack.append((code, pc, parts, resume, data))
+                    code, pc, parts = body, 0, []
+                else:
+                    parts.append(meta.join(strings))
+
+    def generate(self, index, state, write=None):
+        """Generate the variance with the given index in the variance section of the machine.
+
+        The output is returned as a string, or streamed through |write| if given.
+        """
+        slot = self.variances[index]
+        return self.run(self.code[slot][self.objects[slot].select(state)], state, write)
@@ -2,10 +2,13 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import os
-import sys
-import math
-import random
+import time
 import logging
+import threading
+
+
+class DharmaError(Exception):
+    """Raised for malformed grammars and settings, and for test cases which can not be generated or written."""
 
 
 class DharmaConst:
@@ -18,6 +21,112 @@ class DharmaConst:
     VARIANCE_MAX = 8
     VARIABLE_MIN = 1
     VARIABLE_MAX = 4
+    MAX_OUTPUT_BYTES = 0
+    MAX_NODES = 0
+    URI_REFRESH = 0
+
+    @classmethod
+    def snapshot(cls):
+        """Return the current configuration settings as a dict."""
+        return {k: v for k, v in vars(cls).items() if k.isupper()}
+
+    @classmethod
+    def restore(cls, consts):
+        """Apply configuration settings previously taken by snapshot()."""
+        for name, value in consts.items():
+            setattr(cls, name, value)
+
+
+class DharmaResource:
+    """A file or folder referenced by the grammars, loaded on first use.
+
+    Resources are memoized by their resolved path, hence all references to a path share one instance and load it
+    once per process. |reference| is the grammar line which referenced the path first, for the warnings of load().
+    Pickled resources only keep their path and reference and join the registry of the process they are loaded in.
+    """
+
+    registry = {}
+    registry_lock = threading.Lock()
+
+    def __init__(self, path, reference):
+        self.path = path
+        self.reference = reference
+        self.lock = threading.Lock()
+        self.loaded = None
+
+    @classmethod
+    def get(cls, path, reference):
+        """Return the resource of this kind for |path|, referenced by the grammar line |reference|."""
+        key = (cls, os.path.abspath(path))
+        with cls.registry_lock:
+            resource = cls.registry.get(key)
+            if resource is None:
+                resource = cls.registry[key] = cls(path, reference)
+        return resource
+
+    def __reduce__(self):
+        return self.get, (self.path, self.reference)
+
+    def expired(self):
+        return False
+
+    def ensure(self):
+        """Load the resource unless it is loaded and has not expired."""
+        if self.loaded is None or self.expired():
+            with self.lock:
+                if self.loaded is None or self.expired():
+                    self.load()
+                    self.loaded = time.monotonic()
+
+    def load(self):
+        raise NotImplementedError
+
+
+class DharmaBlockResource(DharmaResource):
+    """Content of a file loaded by %block%, the path itself if the file can not be read."""
+
+    def __init__(self, path, reference):
+        DharmaResource.__init__(self, path, reference)
+        self.content = None
+
+    def load(self):
+        try:
+            with open(self.path) as fo:
+                self.content = fo.read()
+        except IOError:
+            logging.warning('%s: Unable to load resource for block() "%s"', self.reference, self.path)
+            self.content = self.path
+
+
+class DharmaURIResource(DharmaResource):
+    """Paths chosen by %uri%: the files in a folder or the path itself.
+
+    Files of a folder are kept as a tuple of names, which are joined with the folder when chosen, in sorted order,
+    hence the choices do not depend on the order of the folder on disk. Folders are listed again once their listing
+    is older than DharmaConst.URI_REFRESH seconds, if set, which picks up files added to a growing corpus.
+    """
+
+    def __init__(self, path, reference):
+        DharmaResource.__init__(self, path, reference)
+        self.folder = ""
+        self.names = ()
+
+    def expired(self):
+        return bool(DharmaConst.URI_REFRESH and self.folder
+                    and time.monotonic() - self.loaded > DharmaConst.URI_REFRESH)
+
+    def load(self):
+        if os.path.isdir(self.path):
+            with os.scandir(self.path) as entries:
+                names = sorted(entry.name for entry in entries if entry.is_file())
+            self.folder, self.names = os.path.join(self.path, ""), tuple(names)
+            if not names:
+                logging.warning('%s: No files in the folder of uri() "%s"', self.reference, self.path)
+                self.folder, self.names = "", (self.path,)
+            return
+        if not os.path.exists(self.path):
+            logging.warning('%s: Unable to identify argument of uri() "%s"', self.reference, self.path)
+        self.folder, self.names = "", (self.path,)
 
 
 class MetaBlock:
@@ -25,16 +134,17 @@ class MetaBlock:
 
     def __init__(self, path, parent):
         self.parent = parent
-        path = os.path.expanduser(path)
-        if os.path.exists(path):
-            with open(path) as fo:
-                self.content = fo.read()
-        else:
-            logging.warning('%s: Unable to load resource for block() "%s"', parent.id(), path)
-            self.content = path
+        self.resource = DharmaBlockResource.get(os.path.expanduser(path), parent.machine.id())
+
+    @property
+    def content(self):
+        self.resource.ensure()
+        return self.resource.content
 
     def generate(self, state):
-        return self.content
+        content = self.content
+        state.size += len(content)
+        return content
 
 
 class MetaURI:
@@ -44,17 +154,46 @@ class MetaURI:
         self.parent = parent
         if path in DharmaConst.URI_TABLE:
             path = DharmaConst.URI_TABLE[path]
-        path = os.path.expanduser(path)
-        if os.path.isdir(path):
-            self.path = [p for p in (os.path.join(path, f) for f in os.listdir(path)) if os.path.isfile(p)]
-        elif os.path.exists(path):
-            self.path = [path]
-        else:
-            logging.warning('%s: Unable to identify argument of uri() "%s"', parent.id(), path)
-            self.path = [path]
+        self.resource = DharmaURIResource.get(os.path.expanduser(path), parent.machine.id())
 
     def generate(self, state):
-        return random.choice(self.path)
+        resource = self.resource
+        resource.ensure()
+        path = resource.folder + state.random.choice(resource.names)
+        state.size += len(path)
+        return path
+
+
+class DistinctExpansions:
+    """Distinct expansions of a %repeat% with nodups, in the order they first occurred.
+
+    Expansions are added one at a time until |count| of them are distinct, the expression is known to have no
+    further distinct expansions, or MAX_MISSES expansions in a row were duplicates, which tells that the remaining
+    ones are unlikely. Duplicates do not count towards the size of the test case.
+    """
+
+    MAX_MISSES = 16
+
+    def __init__(self, meta, count):
+        self.meta = meta
+        self.count = count if meta.space is None else min(count, meta.space)
+        self.strings = {}
+        self.misses = 0
+
+    def add(self, string, state):
+        """Add the expansion |string|, return whether to expand once more."""
+        if string in self.strings:
+            state.size -= len(string)
+            self.misses += 1
+        else:
+            if self.strings:
+                state.size += len(self.meta.separator)
+            self.strings[string] = None
+            self.misses = 0
+        return len(self.strings) < self.count and self.misses < self.MAX_MISSES and not state.exhausted
+
+    def join(self):
+        return self.meta.separator.join(self.strings)
 
 
 class MetaRepeat:
@@ -63,13 +202,37 @@ class MetaRepeat:
     def __init__(self, repeat, separator, nodups, parent):
         self.parent = parent
         self.repeat, self.separator, self.nodups = repeat, separator, nodups
+        # Upper bound of the distinct expansions of the expression, None if unbounded, see DharmaMachine.
+        self.space = None
+
+    def count(self, state):
+        """Return how many times the expression is repeated, only once if the budget of the state is exhausted.
+        Repetitions in progress stop as soon as the budget is exhausted."""
+        if state.exhausted:
+            return 1
+        return state.random.randint(1, 2 ** state.random.randint(1, DharmaConst.MAX_REPEAT_POWER))
+
+    def distinct(self, state):
+        """Return the DistinctExpansions to collect the expansions of a repeat with nodups in."""
+        return DistinctExpansions(self, self.count(state))
+
+    def join(self, strings):
+        return self.separator.join(strings)
 
     def generate(self, state):
-        count = random.randint(1, math.pow(2, random.randint(1, DharmaConst.MAX_REPEAT_POWER)))
-        strings = [self.parent.eval(self.repeat, state) for _ in range(count)]
         if self.nodups:
-            strings = list(set(strings))
-        return self.separator.join(strings)
+            distinct = self.distinct(state)
+            while distinct.add(self.parent.eval(self.repeat, state), state):
+                pass
+            return distinct.join()
+        strings = []
+        for i in range(self.count(state)):
+            if i:
+                state.size += len(self.separator)
+            strings.append(self.parent.eval(self.repeat, state))
+            if state.exhausted:
+                break
+        return self.join(strings)
 
 
 class MetaChoice:
@@ -81,7 +244,9 @@ class MetaChoice:
         self.choices = [x.strip() for x in self.choices.split(",")]
 
     def generate(self, state):
-        return random.choice(self.choices)
+        choice = state.random.choice(self.choices)
+        state.size += len(choice)
+        return choice
 
 
 class MetaRange:
@@ -92,8 +257,7 @@ class MetaRange:
         self.base = None
         # Type identification
         if a is None or b is None:
-            logging.error("%s: Malformed 'range' meta", parent.id())
-            sys.exit(-1)
+            raise DharmaError("%s: Malformed 'range' meta" % parent.machine.id())
         if self._is_char(a) and self._is_char(b):
             self.a, self.b = ord(a), ord(b)
             self.fmt = "c"
@@ -110,9 +274,8 @@ class MetaRange:
                 self.base = 0
         # Type verification
         if type_a != type_b:
-            logging.error("%s: Mismatch in 'range' meta %s/%s in %s",
-                          parent.id(), type_a.__name__, type_b.__name__, parent.ident)
-            sys.exit(-1)
+            raise DharmaError("%s: Mismatch in 'range' meta %s/%s in %s"
+                              % (parent.machine.id(), type_a.__name__, type_b.__name__, parent.ident))
         # Type construction
         try:
             if self.base:
@@ -120,8 +283,8 @@ class MetaRange:
             else:
                 self.a, self.b = type_a(a), type_b(b)
         except ValueError:
-            logging.error("%d: Conversion error %s in 'range' meta", parent.id(), type_b.__name__)
-            sys.exit(-1)
+            raise DharmaError("%s: Conversion error %s in 'range' meta"
+                              % (parent.machine.id(), type_b.__name__)) from None
 
     def _is_char(self, x):
         return len(x) == 1
@@ -134,11 +297,12 @@ class MetaRange:
 
     def generate(self, state):
         if self.fmt == "c":
-            return "%c" % random.randint(self.a, self.b)
-        if self.fmt == "f":
-            return "%g" % random.uniform(self.a, self.b)
-        if self.fmt == "i":
-            if self.base == 16:
-                return "%x" % random.randint(self.a, self.b)
-            return "%d" % random.randint(self.a, self.b)
-        return None
+            value = "%c" % state.random.randint(self.a, self.b)
+        elif self.fmt == "f":
+            value = "%g" % state.random.uniform(self.a, self.b)
+        elif self.base == 16:
+            value = "%x" % state.random.randint(self.a, self.b)
+        else:
+            value = "%d" % state.random.randint(self.a, self.b)
+        state.size += len(value)
+        return value
@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+
+from dharma.core.dharma import DharmaMachine
+from dharma.core.engine import DharmaFlatEngine
+from dharma.core.extensions import DharmaConst, DharmaError
+from dharma.core.rng import rng_backend
+
+
+class DharmaGrammar:
+    """Grammars compiled once, which generate test cases in the calling process.
+
+    Errors in the settings or grammars raise DharmaError. The test case generated by iter_cases() for an index is the
+    one the command line writes for the same seed and -index. Configuration settings are global to DharmaConst, hence
+    every grammar keeps its own and applies them again before generating if another grammar changed them since.
+    """
+
+    # Configuration settings before any settings file or grammar is applied.
+    DEFAULT_CONSTS = DharmaConst.snapshot()
+    SETTINGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "settings.py")
+
+    def __init__(self, sources, settings=None, *, common=True, prefix="", suffix="", template="", seed=0,
+                 engine="flat", rng="random", cache=None):  # pylint: disable=too-many-arguments
+        """|sources| is a list of tuples (namespace, content) of grammars and |settings| the content of a settings
+        file, None for the default settings. With |common| the grammars are preceded by common.dg. |engine| is
+        "flat" or "object", |rng| a name of dharma.core.rng.RNG_BACKENDS and |cache| an optional DharmaGrammarCache.
+        """
+        if engine not in ("object", "flat"):
+            raise DharmaError("Unknown engine: %s" % engine)
+        DharmaConst.restore(self.DEFAULT_CONSTS)
+        self.machine = DharmaMachine(prefix, suffix, template, seed, rng_backend(rng))
+        if settings is None:
+            with open(self.SETTINGS) as fo:
+                self.machine.process_settings(fo)
+        else:
+            self.machine.apply_settings(settings)
+        sources = list(sources)
+        if common:
+            sources[:0] = [self.read(path) for path in self.machine.default_grammar_paths()]
+        self.machine.process_sources(sources, cache)
+        if engine == "flat":
+            self.machine.engine = DharmaFlatEngine(self.machine)
+        self.consts = DharmaConst.snapshot()
+
+    @staticmethod
+    def read(path):
+        """Return the grammar file at |path| as a tuple (namespace, content)."""
+        try:
+            with open(os.path.expanduser(path)) as fo:
+                return os.path.splitext(os.path.basename(path))[0], fo.read()
+        except IOError as error:
+            raise DharmaError("Unable to read grammar %s: %s" % (path, error)) from error
+
+    @classmethod
+    def from_strings(cls, *grammars, **kwargs):
+        """Compile the grammars given as strings, named string1, string2 and so on in messages."""
+        return cls([("string%d" % n, content) for n, content in enumerate(grammars, 1)], **kwargs)
+
+    @classmethod
+    def from_paths(cls, *paths, **kwargs):
+        """Compile the grammar files at |paths|. A path given as |settings| is read as settings file."""
+        settings = kwargs.pop("settings", None)
+        if settings is not None:
+            try:
+                with open(os.path.expanduser(settings)) as fo:
+                    settings = fo.read()
+            except IOError as error:
+                raise DharmaError("Unable to read settings %s: %s" % (settings, error)) from error
+        return cls([cls.read(path) for path in paths], settings, **kwargs)
+
+    @property
+    def seed(self):
+        return self.machine.seed
+
+    def activate(self):
+        if DharmaConst.snapshot() != self.consts:
+            DharmaConst.restore(self.consts)
+
+    def case_seed(self, index):
+        """Return the seed of the test case |index|."""
+        return self.machine.case_seed(self.machine.seed, index)
+
+    def generate(self, seed):
+        """Return the test case generated from |seed|."""
+        self.activate()
+        try:
+            return self.machine.generate_content(seed=seed)
+        except RecursionError:
+            raise DharmaError("Recursion limit exceeded in generating from seed %d, use the flat engine"
+                              % seed) from None
+
+    def generate_case(self, index):
+        """Return the test case |index|, i.e. the one generated from case_seed(|index|)."""
+        self.activate()
+        try:
+            return self.machine.generate_content(index)
+        except RecursionError:
+            raise DharmaError("Recursion limit exceeded in generating test case %d, use the flat engine"
+                              % index) from None
+
+    def iter_cases(self, n, start=1):
+        """Yield the |n| test cases numbered from |start|."""
+        for index in range(start, start + n):
+            yield self.generate_case(index)
@@ -0,0 +1,36 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from itertools import chain
+
+
+class DharmaInstrumentation:
+    """Base of instrumentations which set wrapped methods on the grammar objects of a machine.
+
+    The wrappers are set on the instances, hence generation without an installed instrumentation runs the very same
+    code as before. A method set by another instrumentation is kept and restored on uninstall(), hence several of
+    them can be installed at once, if uninstalled in reverse order. Subclasses implement install().
+    """
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.patched = []
+
+    def objects(self):
+        machine = self.machine
+        return chain(machine.value.values(), machine.variable.values(), machine.variance.values())
+
+    def install(self):
+        raise NotImplementedError('Required method install() not implemented.')
+
+    def uninstall(self):
+        for target, name, method in reversed(self.patched):
+            if method is None:
+                delattr(target, name)
+            else:
+                setattr(target, name, method)
+        self.patched = []
+
+    def patch(self, target, name, method):
+        self.patched.append((target, name, vars(target).get(name)))
+        setattr(target, name, method)
@@ -0,0 +1,127 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import json
+import time
+from itertools import chain
+
+from dharma.core.dharma import DharmaValue, DharmaVariable, MetaRepeat
+from dharma.core.instrument import DharmaInstrumentation
+
+
+class DharmaProfiler(DharmaInstrumentation):
+    """Counts, per value, variable and variance, the expansions, the time spent and the characters produced.
+
+    Further it counts the %repeat% expansions and their repetitions within every object, how often selecting an
+    alternative of a value switched to leaf mode, and the deepest nesting of expansions. The counters are collected
+    by instrumented generate(), select() and count() methods which install() sets on the grammar objects of the
+    machine, hence generation without a profiler runs the very same code as before. The instrumented methods are
+    those of the object engine, the flat engine interleaves all objects on a single stack.
+    """
+
+    FIELDS = ("expansions", "time", "self_time", "size", "repeats", "repetitions", "leaf_triggers", "max_depth")
+    EXPANSIONS, TIME, SELF_TIME, SIZE, REPEATS, REPETITIONS, LEAF_TRIGGERS, MAX_DEPTH = range(8)
+
+    def __init__(self, machine):
+        DharmaInstrumentation.__init__(self, machine)
+        self.stats = {}
+        self.depth = 0
+        self.max_depth = 0
+        # Time spent in the expansions below each expansion in progress.
+        self.children = []
+
+    def counters(self, ident):
+        return self.stats.setdefault(ident, [0, 0.0, 0.0, 0, 0, 0, 0, 0])
+
+    def install(self):
+        for obj in self.objects():
+            self.patch(obj, "generate", self.wrap_generate(obj))
+            if isinstance(obj, DharmaValue):
+                self.patch(obj, "select", self.wrap_select(obj))
+            alternatives = chain.from_iterable(obj) if isinstance(obj, DharmaVariable) else obj
+            for tokens in alternatives:
+                self.patch_repeats(tokens, obj)
+
+    def patch_repeats(self, tokens, obj):
+        for token in tokens:
+            if isinstance(token, MetaRepeat) and "count" not in vars(token):
+                self.patch(token, "count", self.wrap_count(token, obj))
+                self.patch_repeats(token.repeat, obj)
+
+    def wrap_generate(self, obj):
+        generate = obj.generate
+        counters = self.counters(obj.ident)
+        clock = time.perf_counter
+        children = self.children
+
+        def profiled_generate(state):
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            counters[self.MAX_DEPTH] = max(counters[self.MAX_DEPTH], self.depth)
+            children.append(0.0)
+            start = clock()
+            try:
+                result = generate(state)
+            finally:
+                elapsed = clock() - start
+                below = children.pop()
+                if children:
+                    children[-1] += elapsed
+                self.depth -= 1
+            counters[self.EXPANSIONS] += 1
+            counters[self.TIME] += elapsed
+            counters[self.SELF_TIME] += elapsed - below
+            counters[self.SIZE] += len(result)
+            return result
+
+        return profiled_generate
+
+    def wrap_select(self, obj):
+        select = obj.select
+        counters = self.counters(obj.ident)
+
+        def profiled_select(state):
+            leaf_mode = state.leaf_mode
+            index = select(state)
+            if state.leaf_mode and not leaf_mode:
+                counters[self.LEAF_TRIGGERS] += 1
+            return index
+
+        return profiled_select
+
+    def wrap_count(self, meta, obj):
+        count = meta.count
+        counters = self.counters(obj.ident)
+
+        def profiled_count(state):
+            n = count(state)
+            counters[self.REPEATS] += 1
+            counters[self.REPETITIONS] += n
+            return n
+
+        return profiled_count
+
+    def results(self):
+        """Return the counters of every object, keyed by ident, and the deepest nesting of expansions."""
+        return {
+            "max_depth": self.max_depth,
+            "objects": {ident: dict(zip(self.FIELDS, counters)) for ident, counters in self.stats.items()
+                        if counters[self.EXPANSIONS]},
+        }
+
+    def report(self, limit=40, key="self_time"):
+        """Return a table of the |limit| objects which rank highest by |key|."""
+        results = self.results()
+        rows = sorted(results["objects"].items(), key=lambda item: item[1][key], reverse=True)
+        lines = ["%-40s %10s %10s %10s %12s %8s %11s %6s %6s" % (
+            "ident", "expansions", "time ms", "self ms", "characters", "repeats", "repetitions", "leaf", "depth")]
+        for ident, stats in rows[:limit]:
+            lines.append("%-40s %10d %10.1f %10.1f %12d %8d %11d %6d %6d" % (
+                ident, stats["expansions"], stats["time"] * 1000, stats["self_time"] * 1000, stats["size"],
+                stats["repeats"], stats["repetitions"], stats["leaf_triggers"], stats["max_depth"]))
+        lines.append("%d of %d expanded objects, deepest nesting of expansions: %d" % (
+            min(limit, len(rows)), len(rows), results["max_depth"]))
+        return "\n".join(lines)
+
+    def dump(self, fo):
+        json.dump(self.results(), fo, indent=2, sort_keys=True)
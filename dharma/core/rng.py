@@ -0,0 +1,135 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import logging
+import random
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def unsigned_seed(seed):
+    """Map an integer |seed| onto a non-negative one without collisions between the seeds of 64 bit, signed or not.
+
+    random.Random and PCG64 would take the absolute value of a negative seed, hence seed s and -s the same way.
+    Negative seeds map beyond 2 ** 64 instead.
+    """
+    return seed if seed >= 0 else (1 << 64) - 1 - seed
+
+
+class DharmaBatchRandom:
+    """Random generator which draws 64 bit words in batches and maps them onto ranges.
+
+    A word w maps onto range(n) as (w * n) >> 64, without the loop of rejection sampling, which is unbiased for all
+    practical purposes for n up to 2 ** 32. Larger ranges take as many words as needed to keep it so. The words come
+    from random.Random, hence the sequence is deterministic for a seed but differs from the one of random.Random.
+    Provides the methods of random.Random used by the generator: randrange(), randint(), choice() and uniform().
+    """
+
+    # Batches grow from the first to the last size, as most test cases take few draws.
+    BATCH_SIZES = (64, 4096)
+    SMALL = 1 << 32
+
+    def __init__(self, seed=None):
+        self.words = []
+        # The words are taken from the end of the list, the bound method saves an attribute lookup per draw.
+        self.pop = self.words.pop
+        self.batch = self.BATCH_SIZES[0]
+        self.source = None
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        self.source = random.Random(None if seed is None else unsigned_seed(seed))
+        del self.words[:]
+        self.batch = self.BATCH_SIZES[0]
+
+    def draw(self, n):
+        """Return |n| random 64 bit words."""
+        return struct.unpack("<%dQ" % n, self.source.getrandbits(64 * n).to_bytes(8 * n, "little"))
+
+    def word(self):
+        if not self.words:
+            self.words.extend(self.draw(self.batch))
+            self.batch = min(self.batch * 4, self.BATCH_SIZES[1])
+        return self.pop()
+
+    def below(self, w, n):
+        """Map the word |w| onto range(n)."""
+        if n <= self.SMALL:
+            return (w * n) >> 64
+        k = n.bit_length() // 64 + 2
+        for _ in range(k - 1):
+            w = (w << 64) | self.word()
+        return (w * n) >> (64 * k)
+
+    def randrange(self, start, stop=None):
+        try:
+            w = self.pop()
+        except IndexError:
+            w = self.word()
+        if stop is None:
+            if start <= 0:
+                raise ValueError("empty range for randrange()")
+            if start <= self.SMALL:
+                return (w * start) >> 64
+            return self.below(w, start)
+        if stop <= start:
+            raise ValueError("empty range for randrange()")
+        return start + self.below(w, stop - start)
+
+    def randint(self, a, b):
+        try:
+            w = self.pop()
+        except IndexError:
+            w = self.word()
+        n = b - a + 1
+        if 0 < n <= self.SMALL:
+            return a + ((w * n) >> 64)
+        if n <= 0:
+            raise ValueError("empty range for randint()")
+        return a + self.below(w, n)
+
+    def choice(self, seq):
+        try:
+            w = self.pop()
+        except IndexError:
+            w = self.word()
+        if not seq:
+            raise IndexError("cannot choose from an empty sequence")
+        return seq[self.below(w, len(seq))]
+
+    def random(self):
+        return (self.word() >> 11) * (1.0 / (1 << 53))
+
+    def uniform(self, a, b):
+        return a + (b - a) * self.random()
+
+
+class DharmaNumpyRandom(DharmaBatchRandom):
+    """DharmaBatchRandom drawing its words from a NumPy Generator with the PCG64 bit generator."""
+
+    def seed(self, seed=None):
+        self.source = numpy.random.PCG64(None if seed is None else unsigned_seed(seed))
+        del self.words[:]
+        self.batch = self.BATCH_SIZES[0]
+
+    def draw(self, n):
+        return self.source.random_raw(n).tolist()
+
+
+RNG_BACKENDS = {
+    "random": random.Random,
+    "batch": DharmaBatchRandom,
+    "numpy": DharmaNumpyRandom,
+}
+
+
+def rng_backend(name):
+    """Return the random generator class named |name|, numpy falls back to batch if NumPy is not installed."""
+    if name == "numpy" and numpy is None:
+        logging.warning("NumPy is not installed, using the batch random generator instead")
+        name = "batch"
+    return RNG_BACKENDS[name]
@@ -0,0 +1,161 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import queue
+import tarfile
+import threading
+import time
+
+
+class DharmaFileSink:
+    """Writes every test case into a file of its own as it comes."""
+
+    def __init__(self, path, filetype, start, stop):  # pylint: disable=unused-argument
+        self.path = path
+        self.filetype = filetype
+
+    def write(self, index, data):
+        with open(os.path.join(self.path, "%d.%s" % (index, self.filetype)), "wb") as fo:
+            fo.write(data)
+
+    def close(self):
+        pass
+
+
+class DharmaBatchSink:
+    """Writes every test case into a file of its own, in batches of about BATCH_SIZE bytes.
+
+    Files are created relative to a descriptor of the folder where supported, which saves resolving the folder for
+    every file, and written with a single unbuffered write.
+    """
+
+    BATCH_SIZE = 1 << 20
+    FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+
+    def __init__(self, path, filetype, start, stop):  # pylint: disable=unused-argument
+        self.path = path
+        self.filetype = filetype
+        self.batch = []
+        self.size = 0
+        self.dir_fd = None
+        if os.open in os.supports_dir_fd:
+            self.dir_fd = os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+
+    def write(self, index, data):
+        self.batch.append((index, data))
+        self.size += len(data)
+        if self.size >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        for index, data in self.batch:
+            filename = "%d.%s" % (index, self.filetype)
+            if self.dir_fd is None:
+                fd = os.open(os.path.join(self.path, filename), self.FLAGS, 0o666)
+            else:
+                fd = os.open(filename, self.FLAGS, 0o666, dir_fd=self.dir_fd)
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+        self.batch = []
+        self.size = 0
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.dir_fd is not None:
+                os.close(self.dir_fd)
+                self.dir_fd = None
+
+
+class DharmaTarSink:
+    """Appends test cases to a single uncompressed tar archive named after the range of test cases, e.g.
+    1-1000.tar. The archive is written sequentially through a buffer of BUFFER_SIZE bytes, its member headers are
+    the index of the test cases. Headers are built with tarfile, but written directly, which skips the bookkeeping
+    of TarFile.addfile().
+    """
+
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, path, filetype, start, stop):
+        self.filetype = filetype
+        self.filename = os.path.join(path, "%d-%d.tar" % (start, stop - 1))
+        self.mtime = int(time.time())
+        self.offset = 0
+        self.file = open(self.filename, "wb", self.BUFFER_SIZE)
+
+    def write(self, index, data):
+        info = tarfile.TarInfo("%d.%s" % (index, self.filetype))
+        info.size = len(data)
+        info.mtime = self.mtime
+        info.mode = 0o644
+        padding = -len(data) % tarfile.BLOCKSIZE
+        self.file.write(info.tobuf(tarfile.USTAR_FORMAT))
+        self.file.write(data)
+        self.file.write(tarfile.NUL * padding)
+        self.offset += tarfile.BLOCKSIZE + len(data) + padding
+
+    def close(self):
+        try:
+            # End of archive marker, padded to a full record.
+            end = self.offset + 2 * tarfile.BLOCKSIZE
+            self.file.write(tarfile.NUL * (end - self.offset + (-end % tarfile.RECORDSIZE)))
+        finally:
+            self.file.close()
+
+
+class DharmaThreadedSink:
+    """Hands test cases to a thread which writes them to |sink|, which overlaps the I/O with generation.
+
+    The first error of the thread is raised by a following write() or by close().
+    """
+
+    QUEUE_SIZE = 64
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.queue = queue.Queue(self.QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="DharmaThreadedSink")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    self.sink.write(*item)
+                except Exception as error:  # pylint: disable=broad-except
+                    # Raised by the next write() or close(), the queue is drained meanwhile.
+                    self.error = error
+        try:
+            self.sink.close()
+        except Exception as error:  # pylint: disable=broad-except
+            if self.error is None:
+                self.error = error
+
+    def write(self, index, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((index, data))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+SINKS = {
+    "files": DharmaFileSink,
+    "batch": DharmaBatchSink,
+    "tar": DharmaTarSink,
+}
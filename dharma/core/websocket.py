@@ -8,8 +8,10 @@ import hashlib
 import logging
 import socket
 import struct
-import sys
 import json
+import threading
+import zlib
+from itertools import count
 
 try:
     # python 3
@@ -19,118 +21,299 @@ except ImportError:
     from SocketServer import BaseRequestHandler, TCPServer, ThreadingMixIn
 
 
+OPCODES = {
+    0: 'continue',
+    1: 'text',
+    2: 'binary',
+    8: 'close',
+    9: 'ping',
+    10: 'pong'
+}
+
+# Largest message a client may send, larger ones close the connection with status 1009 (message too big).
+MAX_MESSAGE_SIZE = 1 << 24
+CLOSE_TOO_BIG = struct.pack('!H', 1009)
+
+
+def handshake_response(key):
+    """Return the response accepting a WebSocket upgrade request with the given Sec-WebSocket-Key."""
+    hresponse = hashlib.sha1(key.encode('ascii'))
+    hresponse.update(b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11')
+    resp = email.message.Message()
+    resp.add_header('Upgrade', 'websocket')
+    resp.add_header('Connection', 'Upgrade')
+    resp.add_header('Sec-WebSocket-Accept', base64.b64encode(hresponse.digest()).decode('ascii'))
+    resp = resp.as_string(unixfrom=False).replace('\n', '\r\n')
+    return 'HTTP/1.1 101 Switching Protocols\r\n{}'.format(resp).encode('ascii')
+
+
+def frame_header(opcode, length):
+    """Return the header of an unmasked final frame with the given opcode and payload length."""
+    out = bytearray()
+    out.append(0x80 | opcode)
+    if length <= 125:
+        out.append(length)
+    elif length <= 65535:
+        out.append(126)
+        out.extend(struct.pack('!H', length))
+    else:
+        out.append(127)
+        out.extend(struct.pack('!Q', length))
+    return out
+
+
+def unmask(data, mask):
+    """Unmask the payload of a frame sent by a client.
+
+    The payload is XORed with the repeated mask as one integer, instead of byte by byte in Python.
+    """
+    length = len(data)
+    if not length:
+        return b''
+    key = (bytes(mask) * (length // 4 + 1))[:length]
+    return (int.from_bytes(data, 'little') ^ int.from_bytes(key, 'little')).to_bytes(length, 'little')
+
+
+class FrameHeader:
+    """Header of a frame sent by a client, parsed without doing any I/O.
+
+    The first two bytes of the frame given to the constructor tell |remaining|, the number of header bytes which
+    follow for an extended payload length and the mask. Once they are passed to complete(), |length| is the length
+    of the payload which follows.
+    """
+
+    def __init__(self, head):
+        self.fin = bool(head[0] & 0x80)
+        self.opcode = head[0] & 0xF
+        self.masked = bool(head[1] & 0x80)
+        self.length = head[1] & 0x7F
+        self.mask = None
+        self.remaining = {126: 2, 127: 8}.get(self.length, 0) + (4 if self.masked else 0)
+
+    def complete(self, rest):
+        """Take the |remaining| bytes of the header."""
+        rest = bytes(rest)
+        if self.length >= 126:
+            size = 2 if self.length == 126 else 8
+            self.length, rest = int.from_bytes(rest[:size], 'big'), rest[size:]
+        if self.masked:
+            self.mask = rest
+        self.remaining = 0
+
+    def exceeds(self, buffered):
+        """Return whether the message, of which |buffered| bytes came before this frame, exceeds MAX_MESSAGE_SIZE."""
+        return self.length + (buffered if self.opcode == 0 else 0) > MAX_MESSAGE_SIZE
+
+    def payload(self, data):
+        """Return the received payload |data| unmasked."""
+        return unmask(data, self.mask) if self.mask is not None else bytes(data)
+
+
+# Most test cases a client gets in one message.
+BATCH_LIMIT = 1024
+
+
+def batch_options(msg):
+    """Return the tuple (count, binary, compress) requested by the message of a client.
+
+    A client asks for several test cases at once with {"count": N}, for a binary frame with {"binary": true} and
+    for a binary frame compressed with zlib with {"compress": true}. A message without any of them asks for a single
+    test case sent as plain text, which is all a client knew to ask for before.
+    """
+    n = max(1, min(int(msg.get("count", 1)), BATCH_LIMIT))
+    compress = bool(msg.get("compress"))
+    return n, compress or bool(msg.get("binary")), compress
+
+
+def encode_batch(cases, binary=False, compress=False):
+    """Encode a batch of test cases given as tuples (index, seed, content) into a message.
+
+    As text, the message is a JSON object {"cases": [{"index": n, "seed": s, "content": "..."}, ...]}. As binary,
+    the message starts with the length of a JSON header as 4 byte unsigned big endian integer, followed by the
+    header {"cases": [{"index": n, "seed": s, "size": bytes}, ...], "compress": "zlib" or null} and the UTF-8
+    encoded contents one after another, compressed as a whole if requested.
+    """
+    if not binary:
+        return json.dumps({"cases": [{"index": n, "seed": seed, "content": content} for n, seed, content in cases]})
+    contents = [content.encode('utf8', 'surrogatepass') for _, _, content in cases]
+    header = json.dumps({
+        "cases": [{"index": n, "seed": seed, "size": len(data)} for (n, seed, _), data in zip(cases, contents)],
+        "compress": "zlib" if compress else None
+    }).encode('ascii')
+    body = b''.join(contents)
+    if compress:
+        body = zlib.compress(body)
+    return b''.join((struct.pack('!I', len(header)), header, body))
+
+
+def parse_message(message):
+    """Return the test cases a client asks for with |message| as tuple (count, binary, compress, batched), None if
+    it asks for none. Status messages are logged, malformed JSON raises ValueError.
+    """
+    msg = json.loads(message)
+    status = msg.get("status")
+    if status == "open":
+        logging.info("WebSocket connection opened.")
+    if status in ("open", "success"):
+        return batch_options(msg) + (len(msg) > 1,)
+    if status == "closed":
+        logging.info("WebSocket connection closed.")
+    else:
+        logging.error("WebSocket received unexpected message %r", msg)
+    return None
+
+
+def encode_reply(cases, request):
+    """Encode the test cases given as tuples (index, seed, content) which answer a |request| of parse_message().
+    Returns the tuple (message, binary).
+    """
+    _, binary, compress, batched = request
+    if not batched:
+        logging.debug("Serving test case %d", cases[0][0])
+        return cases[0][2], False
+    logging.debug("Serving test cases %d to %d", cases[0][0], cases[-1][0])
+    return encode_batch(cases, binary, compress), binary
+
+
 class BaseWebSocketHandler(BaseRequestHandler):
     """Base class for WebSocket server."""
 
     REQUEST_TIMEOUT = 0.01
-    _OPCODES = {
-        0: 'continue',
-        1: 'text',
-        2: 'binary',
-        8: 'close',
-        9: 'ping',
-        10: 'pong'
-    }
-
-    def handle(self):  # pylint: disable=too-many-branches,too-many-statements
-        self.request.settimeout(self.REQUEST_TIMEOUT)
-        str_t = str if sys.version_info[0] == 3 else lambda a, b: str(a).encode(b)
-        while not self.should_close():
+    # Initial size of the receive buffer, it grows to the largest frame received.
+    BUFFER_SIZE = 1 << 16
+    _OPCODES = OPCODES
+
+    def setup(self):
+        self._buffer = bytearray(self.BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+
+    def _recv_exactly(self, length):
+        """Receive exactly |length| bytes into the receive buffer and return a view of them, which is valid until the
+        next call. Raises EOFError if the connection got closed.
+        """
+        if length > len(self._buffer):
+            self._view.release()
+            self._buffer = bytearray(length)
+            self._view = memoryview(self._buffer)
+        view = self._view[:length]
+        received = 0
+        while received < length:
+            try:
+                n = self.request.recv_into(view[received:])
+            except socket.timeout:
+                if self.should_close():
+                    raise EOFError() from None
+                continue
+            if not n:
+                raise EOFError()
+            received += n
+        return view
+
+    def _recv_request(self):
+        """Receive the HTTP request which opens the connection, returns None if the connection got closed."""
+        request = bytearray()
+        while b'\r\n\r\n' not in request:
             try:
-                _, headers = str_t(self.request.recv(1024), 'ascii').split('\r\n', 1)
-                break
+                data = self.request.recv(1024)
             except socket.timeout:
-                # time.sleep(0.01)
-                # print 'timeout 29'
+                if self.should_close():
+                    return None
                 continue
+            if not data:
+                return None
+            request += data
+        return request.decode('ascii')
+
+    def _recv_frame(self, buffered):
+        """Return the next frame as a tuple (fin, opcode, payload), or None if a message of |buffered| bytes so far
+        would exceed MAX_MESSAGE_SIZE, after closing the connection.
+        """
+        header = FrameHeader(self._recv_exactly(2))
+        if header.remaining:
+            header.complete(self._recv_exactly(header.remaining))
+        if header.exceeds(buffered):
+            logging.warning('Closing connection on a message exceeding %d bytes', MAX_MESSAGE_SIZE)
+            self._send(8, CLOSE_TOO_BIG)
+            return None
+        return header.fin, header.opcode, header.payload(self._recv_exactly(header.length))
+
+    def handle(self):  # pylint: disable=too-many-branches
+        self.request.settimeout(self.REQUEST_TIMEOUT)
+        request = self._recv_request()
+        if request is None:
+            return
+        _, headers = request.split('\r\n', 1)
         headers = email.parser.HeaderParser().parsestr(headers)
         # TODO(jschwartzentruber): validate request/headers
-        hresponse = hashlib.sha1(headers['sec-websocket-key'].encode('ascii'))
-        hresponse.update(b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11')
-        resp = email.message.Message()
-        resp.add_header('Upgrade', 'websocket')
-        resp.add_header('Connection', 'Upgrade')
-        resp.add_header('Sec-WebSocket-Accept', str_t(base64.b64encode(hresponse.digest()), 'ascii'))
-        resp = resp.as_string(unixfrom=False).replace('\n', '\r\n')
-        self.request.sendall('HTTP/1.1 101 Switching Protocols\r\n{}'.format(resp).encode('ascii'))
+        self._sendall(handshake_response(headers['sec-websocket-key']))
         self.open()
         buf = None
         buf_op = None
         try:
             while not self.should_close():
                 try:
-                    data = struct.unpack('BB', self.request.recv(2))
-                except socket.timeout:
-                    # no data
-                    # time.sleep(0.01)
-                    # print 'timeout 51'
-                    continue
-                except struct.error:
+                    frame = self._recv_frame(len(buf) if buf is not None else 0)
+                except EOFError:
                     break  # chrome doesn't send a close-frame
-                fin, mask = bool(data[0] & 0x80), bool(data[1] & 0x80)
-                opcode = self._OPCODES[data[0] & 0xF]
+                if frame is None:
+                    break
+                fin, code, data = frame
+                opcode = self._OPCODES.get(code)
                 if opcode == 'close':
                     break
                 if opcode == 'pong':
                     self.on_pong()
                     continue
-                length = data[1] & 0x7F
-                if length == 126:
-                    length = struct.unpack('!H', self.request.recv(2))[0]
-                elif length == 127:
-                    length = struct.unpack('!Q', self.request.recv(8))[0]
-                mask = bytearray(self.request.recv(4)) if mask else None
-                data = bytearray(self.request.recv(length))
-                if mask is not None:
-                    data = bytearray((b ^ mask[i % 4]) for (i, b) in enumerate(data))
-                if opcode == 'continue':
-                    assert buf is not None
-                    opcode = buf_op
-                elif opcode == 'ping':
+                if opcode == 'ping':
                     self._send(10, data)
                     continue
-                elif buf is not None:
-                    logging.warning('Received a new frame while waiting for another to finish, '
-                                    'discarding %u bytes of %u', len(buf), buf_op)
-                    buf = buf_op = None
-                if opcode == 'text':
-                    data = str_t(data, 'utf8')
-                elif opcode != 'binary':
-                    logging.warning('Unknown websocket opcode "%s"', opcode)
-                    continue
-                if buf is None:
-                    buf = data
-                    buf_op = opcode
-                else:
+                if opcode == 'continue':
+                    if buf is None:
+                        logging.warning('Received a continuation frame without a message to continue')
+                        continue
                     buf += data
+                elif opcode in ('text', 'binary'):
+                    if buf is not None:
+                        logging.warning('Received a new frame while waiting for another to finish, '
+                                        'discarding %u bytes of %s', len(buf), buf_op)
+                    buf, buf_op = (data if fin else bytearray(data)), opcode
+                else:
+                    logging.warning('Unknown websocket opcode %d', code)
+                    continue
                 if fin:
-                    self.on_message(buf)
+                    self.on_message(buf.decode('utf8') if buf_op == 'text' else bytes(buf))
                     buf = buf_op = None
         finally:
             self.on_close()
 
     def finish(self):
-        pass
+        self._view.release()
+
+    def _sendall(self, *buffers):
+        """Send the buffers with as few system calls as possible and without joining them first."""
+        buffers = [memoryview(data).cast('B') for data in buffers if len(data)]
+        if not hasattr(self.request, 'sendmsg'):
+            for data in buffers:
+                self.request.sendall(data)
+            return
+        while buffers:
+            try:
+                sent = self.request.sendmsg(buffers)
+            except socket.timeout:
+                continue
+            while sent:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers.pop(0))
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
 
     def _send(self, opcode, data):
-        length = len(data)
-        out = bytearray()
-        out.append(0x80 | opcode)
-        if length <= 125:
-            out.append(length)
-        elif length <= 65535:
-            out.append(126)
-            out.extend(struct.pack('!H', length))
-        else:
-            out.append(127)
-            out.extend(struct.pack('!Q', length))
-        if length:
-            out.extend(data)
-        self.request.sendall(out)
+        self._sendall(frame_header(opcode, len(data)), data)
 
     # Below is the partial API from tornado.websocket.WebSocketHandler
     def ping(self):
-        self._send(9, '')
+        self._send(9, b'')
 
     def should_close(self):
         """When this returns true, the message loop will exit."""
@@ -162,25 +345,47 @@ class DharmaTCPServer(ThreadingMixIn, TCPServer):
 
 
 class DharmaWebSocketServer:
-    def __init__(self, machine, address=("127.0.0.1", 9090)):
+    """WebSocket server with a thread per connection.
+
+    Every served test case gets the next number, from which its seed is derived like for -storage. The connections
+    share the machine, which keeps the state of a generation apart from the grammars. Test cases found in the
+    DharmaBloomFilter |dedup| are skipped.
+    """
+
+    def __init__(self, machine, address=("127.0.0.1", 9090), dedup=None):
         self.server = None
         self.machine = machine
         self.address = address
+        self.dedup = dedup
+        self.numbers = count(1)
+        self.lock = threading.Lock()
+
+    def next_number(self):
+        with self.lock:
+            return next(self.numbers)
+
+    def next_testcase(self):
+        """Return the number and content of the next test case to serve, see DharmaBloomFilter.skip()."""
+        while True:
+            n = self.next_number()
+            content = self.machine.generate_content(n)
+            if self.dedup is None or not self.dedup.skip(content.encode('utf8', 'surrogatepass')):
+                return n, content
 
     def start(self):
         machine = self.machine
+        next_testcase = self.next_testcase
 
         class DharmaWebSocketHandler(BaseWebSocketHandler):
             def on_message(self, message):
-                msg = json.loads(message)
-                if msg.get("status") == "open":
-                    logging.info("WebSocket connection opened.")
-                if msg.get("status") in ("open", "success"):
-                    self.write_message(machine.generate_content())
-                elif msg.get("status") == "closed":
-                    logging.info("WebSocket connection closed.")
-                else:
-                    logging.error("WebSocket received unexpected message %r", msg)
+                request = parse_message(message)
+                if request is None:
+                    return
+                cases = []
+                for _ in range(request[0]):
+                    n, content = next_testcase()
+                    cases.append((n, machine.case_seed(machine.seed, n), content))
+                self.write_message(*encode_reply(cases, request))
 
         try:
             self.server = DharmaTCPServer(self.address, DharmaWebSocketHandler)
@@ -196,5 +401,7 @@ class DharmaWebSocketServer:
         try:
             logging.info("Stopping WebSocket server.")
             self.server.shutdown()
+            if self.dedup is not None:
+                self.dedup.report()
         except Exception as error:  # pylint: disable=broad-except
             logging.error("Unable to shutdown WebSocket server: %s", error)
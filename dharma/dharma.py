@@ -4,19 +4,59 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import argparse
 import logging
+import mimetypes
 import os
-import random
 import struct
 import sys
 
 from .__version__ import __version__, __title__
+from .core.asyncserver import DharmaAsyncHTTPServer, DharmaAsyncWebSocketServer
+from .core.cache import DharmaGrammarCache
+from .core.coverage import DharmaCoverage
+from .core.dedup import DharmaBloomFilter
 from .core.dharma import DharmaMachine
+from .core.extensions import DharmaError
+from .core.engine import DharmaFlatEngine
+from .core.profile import DharmaProfiler
+from .core.rng import RNG_BACKENDS, rng_backend
 from .core.websocket import DharmaWebSocketServer
 
 
 class DharmaCommandLine:
     @staticmethod
-    def parse_args():
+    def case_number(value):
+        """Parse a test case number, which starts at 1."""
+        try:
+            number = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError('invalid number: %r' % value) from None
+        if number < 1:
+            raise argparse.ArgumentTypeError('test cases are numbered from 1: %r' % value)
+        return number
+
+    @staticmethod
+    def case_range(value):
+        """Parse a range of test case numbers given as 'a-b'."""
+        try:
+            start, stop = (int(n) for n in value.split('-', 1))
+        except ValueError:
+            raise argparse.ArgumentTypeError('invalid range: %r' % value) from None
+        if not 1 <= start <= stop:
+            raise argparse.ArgumentTypeError('invalid range: %r' % value)
+        return start, stop
+
+    @staticmethod
+    def error_rate(value):
+        try:
+            rate = float(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError('invalid rate: %r' % value) from None
+        if not 0 < rate < 1:
+            raise argparse.ArgumentTypeError('rate must be between 0 and 1: %r' % value)
+        return rate
+
+    @classmethod
+    def parse_args(cls):
         parser = argparse.ArgumentParser(
             add_help=False,
             description='Dharma Runtime',
@@ -30,49 +70,197 @@ class DharmaCommandLine:
                        help='input grammars')
 
         o = parser.add_argument_group('optional arguments')
+        o.add_argument('-cache', metavar='path',
+                       help='folder for compiled grammars, reused by later runs with identical input')
         o.add_argument('-count', metavar='#', type=int, default=1, help='number of test cases')
+        o.add_argument('-coverage', metavar='file',
+                       help='count which alternatives are expanded and add the counts to this JSON file')
+        o.add_argument('-coverage-guided', action='store_true',
+                       help='favour the alternatives expanded least so far, counted by -coverage and this run')
+        o.add_argument('-dedup', action='store_true',
+                       help='skip test cases identical to one generated before, tracked by a bloom filter')
+        o.add_argument('-dedup-capacity', metavar='#', type=int,
+                       help='number of unique test cases the filter of -dedup is sized for, defaults to -count or '
+                            '1000000 in server mode')
+        o.add_argument('-dedup-error-rate', metavar='p', type=cls.error_rate, default=0.001,
+                       help='probability of -dedup taking a unique test case for a duplicate')
+        o.add_argument('-engine', choices=('object', 'flat'), default='object',
+                       help='generate by recursing through the grammar objects or by running a flat compiled program '
+                            'on an explicit stack, which also streams within a variance to -storage and stdout')
         o.add_argument('-format', metavar='ext', default='html', help='format of test cases')
         o.add_argument('-h', '-help', '--help', action='help', help=argparse.SUPPRESS)
+        c = o.add_mutually_exclusive_group()
+        c.add_argument('-index', metavar='#', type=cls.case_number,
+                       help='regenerate only the test case with this number, overrides -count')
+        c.add_argument('-range', metavar='a-b', type=cls.case_range,
+                       help='regenerate only the test cases numbered a to b, overrides -count')
+        o.add_argument('-jobs', metavar='#', type=int, default=1,
+                       help='number of processes generating test cases for -storage, -server-async and -server-http')
         o.add_argument('-logging', metavar='#', default=10, type=int, choices=range(10, 60, 10),
                        help='verbosity level of logging')
         o.add_argument('-prefix', metavar='file', type=argparse.FileType(), help='prefix data')
+        o.add_argument('-profile', action='store_true',
+                       help='count expansions, time and output of every value, variable and variance and print the '
+                            'top of them to stderr at the end, for -storage and stdout')
+        o.add_argument('-profile-json', metavar='file',
+                       help='write the counters of -profile for all objects as JSON to this file')
         o.add_argument('-recursion-limit', metavar='#', type=int, default=20000,
-                       help='max python recursion limit')
+                       help='max python recursion limit, deep expansions need a high limit with the object engine')
+        o.add_argument('-rng', choices=sorted(RNG_BACKENDS), default='random',
+                       help='random generator: random.Random, or 64 bit words drawn in batches from random.Random or '
+                            'from NumPy if installed; a seed gives other test cases with each of them')
         o.add_argument('-seed', metavar='#', type=int,
                        help='seed value for random, os.urandom will be used if not specified')
         o.add_argument('-server', action='store_true', help='run in server mode')
+        o.add_argument('-server-async', action='store_true',
+                       help='serve test cases from an asyncio event loop, generated ahead by -jobs processes')
+        o.add_argument('-server-http', action='store_true',
+                       help='serve test cases at /testcase over HTTP instead of WebSocket, generated like '
+                            '-server-async')
         o.add_argument('-server-host', metavar='host', type=str, default='127.0.0.1', help='server address')
         o.add_argument('-server-port', metavar='#', type=int, default=9090, help='server port')
+        o.add_argument('-server-queue', metavar='#', type=int, default=64,
+                       help='number of test cases generated ahead for -server-async and -server-http')
         o.add_argument('-settings', metavar='file', type=argparse.FileType(),
                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settings.py'),
                        help='')
+        o.add_argument('-sink', choices=('files', 'batch', 'tar'), default='files',
+                       help='how -storage is written: a file streamed per test case, a file per test case written in '
+                            'batches or a single tar archive')
+        o.add_argument('-sink-thread', action='store_true',
+                       help='write test cases of -storage in a background thread')
         o.add_argument('-storage', metavar='path', help='folder for test cases')
         o.add_argument('-suffix', metavar='file', type=argparse.FileType(), help='suffix data')
         o.add_argument('-template', metavar='file', type=argparse.FileType(), help='template data')
         o.add_argument('-version', action='version', version='%(prog)s {}'.format(__version__),
                        help=argparse.SUPPRESS)
 
-        return parser.parse_args()
+        args = parser.parse_args()
+        # Both servers run in server mode without -server.
+        args.server = args.server or args.server_async or args.server_http
+        return args
 
     @classmethod
     def main(cls):
         args = cls.parse_args()
         sys.setrecursionlimit(args.recursion_limit)
         logging.basicConfig(format='[Dharma] %(asctime)s %(levelname)s: %(message)s', level=args.logging)
+        try:
+            return cls.run(args)
+        except DharmaError as error:
+            logging.error('%s', error)
+            return -1
+
+    @staticmethod
+    def setup_profiler(args, dharma):
+        """Return an installed DharmaProfiler if profiling is requested, else None."""
+        if not (args.profile or args.profile_json):
+            return None
+        if args.server:
+            logging.warning('Profiling is not supported in server mode')
+            return None
+        if args.engine == 'flat':
+            logging.warning('Profiling with the object engine, test cases are the same as with the flat engine')
+            args.engine = 'object'
+        if args.jobs > 1:
+            logging.warning('Profiling in a single process')
+            args.jobs = 1
+        profiler = DharmaProfiler(dharma)
+        profiler.install()
+        return profiler
+
+    @staticmethod
+    def setup_coverage(args, dharma):
+        """Return an installed DharmaCoverage if coverage is requested, else None."""
+        if not (args.coverage or args.coverage_guided):
+            return None
+        if args.server_async or args.server_http:
+            logging.warning('Coverage is only supported by the threaded server')
+            return None
+        if args.jobs > 1:
+            logging.warning('Counting coverage in a single process')
+            args.jobs = 1
+        coverage = DharmaCoverage(dharma, args.coverage_guided)
+        if args.coverage:
+            coverage.load(args.coverage)
+        coverage.install()
+        return coverage
+
+    @staticmethod
+    def create_server(args, dharma, dedup):
+        address = (args.server_host, args.server_port)
+        if args.server_http:
+            content_type = mimetypes.guess_type('testcase.%s' % args.format)[0] or 'application/octet-stream'
+            return DharmaAsyncHTTPServer(dharma, address, args.jobs, args.server_queue, dedup, content_type)
+        if args.server_async:
+            return DharmaAsyncWebSocketServer(dharma, address, args.jobs, args.server_queue, dedup)
+        return DharmaWebSocketServer(dharma, address, dedup)
+
+    @staticmethod
+    def write_stdout(dharma, start, count, dedup):
+        """Write the test cases numbered from |start| to stdout, skipping duplicates found in |dedup|."""
+        for n in range(start, start + count):
+            if dedup is None:
+                dharma.generate_stream(sys.stdout.write, n)
+            else:
+                content = dharma.generate_content(n)
+                if dedup.add(content.encode('utf-8', 'surrogatepass')):
+                    continue
+                sys.stdout.write(content)
+            sys.stdout.write('\n')
+
+    @staticmethod
+    def finish(args, dedup, coverage, profiler):
+        """Report the duplicates, coverage and profile of a run and return its exit code."""
+        if dedup is not None and not args.server:
+            dedup.report()
+        if coverage is not None:
+            coverage.uninstall()
+            logging.info('%s', coverage.report())
+            if args.coverage:
+                coverage.save(args.coverage)
+        if profiler is not None:
+            profiler.uninstall()
+            if args.profile:
+                sys.stderr.write(profiler.report() + '\n')
+            if args.profile_json:
+                try:
+                    with open(args.profile_json, 'w') as fo:
+                        profiler.dump(fo)
+                except IOError as error:
+                    logging.error('Unable to write profile: %s', error)
+                    return -1
+        return 0
+
+    @classmethod
+    def run(cls, args):
         if args.seed is None:
             args.seed = struct.unpack('q', os.urandom(8))[0]
-        random.seed(args.seed)
         logging.info('Machine random seed: %d', args.seed)
         prefix_data = '' if not args.prefix else args.prefix.read()
         suffix_data = '' if not args.suffix else args.suffix.read()
         template_data = '' if not args.template else args.template.read()
-        dharma = DharmaMachine(prefix_data, suffix_data, template_data)
+        dharma = DharmaMachine(prefix_data, suffix_data, template_data, args.seed, rng_backend(args.rng))
         dharma.process_settings(args.settings)
-        dharma.process_grammars(args.grammars)
+        dharma.process_grammars(args.grammars, DharmaGrammarCache(args.cache) if args.cache else None)
+        profiler = cls.setup_profiler(args, dharma)
+        coverage = cls.setup_coverage(args, dharma)
+        if args.engine == 'flat':
+            dharma.engine = DharmaFlatEngine(dharma)
+        start, count = 1, args.count
+        if args.index is not None:
+            start, count = args.index, 1
+        elif args.range is not None:
+            start, count = args.range[0], args.range[1] - args.range[0] + 1
+        dedup = None
+        if args.dedup:
+            capacity = args.dedup_capacity or (1000000 if args.server and not args.storage else count)
+            dedup = DharmaBloomFilter(capacity, args.dedup_error_rate)
         if args.storage:
-            dharma.generate_testcases(args.storage, args.format, args.count)
+            dharma.generate_testcases(args.storage, args.format, count, args.jobs, start, args.sink, args.sink_thread,
+                                      dedup)
         elif args.server:
-            server = DharmaWebSocketServer(dharma, (args.server_host, args.server_port))
+            server = cls.create_server(args, dharma, dedup)
             try:
                 server.start()
             except KeyboardInterrupt:
@@ -80,6 +268,5 @@ class DharmaCommandLine:
             finally:
                 server.stop()
         else:
-            for _ in range(args.count):
-                print(dharma.generate_content())
-        return 0
+            cls.write_stdout(dharma, start, count, dedup)
+        return cls.finish(args, dedup, coverage, profiler)
@@ -6,6 +6,9 @@ DharmaConst.VARIABLE_MAX = 4
 DharmaConst.VARIANCE_TEMPLATE = "%s"
 DharmaConst.MAX_REPEAT_POWER = 12
 DharmaConst.LEAF_TRIGGER = 256
+DharmaConst.MAX_OUTPUT_BYTES = 0
+DharmaConst.MAX_NODES = 0
+DharmaConst.URI_REFRESH = 0
 DharmaConst.URI_TABLE = {
     "images": "fuzzdata/samples/jpg/",
     "videos": "fuzzdata/samples/mp4/",